@@ -0,0 +1,133 @@
+"""Synthetic inputs for the benchmarks: FASTA files, HMMER domtblout and MMseqs search tables
+
+Every generator takes a seed, so the same arguments always write the same file and timings
+from different runs are comparable.
+"""
+import numpy as np
+
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype = np.uint8)
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype = np.uint8)
+
+
+def record_lengths(num_records, mean_length = 5000, sigma = 1.0, min_length = 100, seed = 0):
+    """Draws log-normally distributed record lengths, like contigs of an assembly
+
+    Args:
+        num_records (int): Number of lengths to draw
+        mean_length (int, optional): Mean length. Defaults to 5000.
+        sigma (float, optional): Log-normal shape; 0 makes every record mean_length long. Defaults to 1.0.
+        min_length (int, optional): Shortest allowed length. Defaults to 100.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: int64 lengths
+    """
+    rng = np.random.default_rng(seed)
+    if sigma == 0:
+        return np.full(num_records, mean_length, dtype = np.int64)
+    lengths = rng.lognormal(np.log(mean_length) - sigma ** 2 / 2, sigma, num_records)
+    return np.maximum(lengths, min_length).astype(np.int64)
+
+
+def write_fasta(output_file, num_records = 10000, mean_length = 5000, sigma = 1.0, alphabet = 'nucleotide',
+                line_width = 80, n_fraction = 0.001, seed = 0):
+    """Writes a random FASTA
+
+    Args:
+        output_file (str): Path to output FASTA
+        num_records (int, optional): Number of records. Defaults to 10000.
+        mean_length (int, optional): Mean record length. Defaults to 5000.
+        sigma (float, optional): Log-normal shape of the length distribution. Defaults to 1.0.
+        alphabet (str, optional): 'nucleotide' or 'protein'. Defaults to 'nucleotide'.
+        line_width (int, optional): Sequence line width, 0 for single-line records. Defaults to 80.
+        n_fraction (float, optional): Fraction of nucleotide bases replaced by N. Defaults to 0.001.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        str: output_file
+    """
+    rng = np.random.default_rng(seed)
+    letters = NUCLEOTIDES if alphabet == 'nucleotide' else AMINO_ACIDS
+    lengths = record_lengths(num_records, mean_length, sigma, seed = seed)
+    with open(output_file, 'wb') as outf:
+        for i, length in enumerate(lengths):
+            sequence = letters[rng.integers(0, len(letters), length)]
+            if alphabet == 'nucleotide' and n_fraction:
+                sequence[rng.random(length) < n_fraction] = ord('N')
+            sequence = sequence.tobytes()
+            if line_width:
+                sequence = b'\n'.join(sequence[j:j + line_width] for j in range(0, length, line_width))
+            outf.write(b'>contig_' + str(i).encode() + b' synthetic record\n' + sequence + b'\n')
+    return output_file
+
+
+def write_domtblout(output_file, num_hits = 100000, num_targets = 20000, num_queries = 500, seed = 0):
+    """Writes a random hmmsearch --domtblout table, column-aligned like HMMER's own output
+
+    Args:
+        output_file (str): Path to output table
+        num_hits (int, optional): Number of domain rows. Defaults to 100000.
+        num_targets (int, optional): Number of distinct target sequences. Defaults to 20000.
+        num_queries (int, optional): Number of distinct query HMMs. Defaults to 500.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        str: output_file
+    """
+    rng = np.random.default_rng(seed)
+    targets = rng.integers(0, num_targets, num_hits)
+    queries = rng.integers(0, num_queries, num_hits)
+    target_lens = rng.integers(100, 1500, num_targets)
+    query_lens = rng.integers(50, 600, num_queries)
+    evalues = 10.0 ** -rng.uniform(1, 80, num_hits)
+    scores = rng.uniform(10, 500, num_hits)
+    with open(output_file, 'w') as outf:
+        outf.write('# target name        accession   tlen query name           accession   qlen   E-value  score  bias'
+                   '   #  of  c-Evalue  i-Evalue  score  bias  from    to  from    to  from    to  acc description of target\n')
+        outf.write('#------------------- ---------- ----- -------------------- ---------- ----- --------- ------ -----'
+                   ' --- --- --------- --------- ------ ----- ----- ----- ----- ----- ----- ----- ---- ---------------------\n')
+        for i in range(num_hits):
+            target, query = targets[i], queries[i]
+            tlen, qlen = target_lens[target], query_lens[query]
+            hmm_from = rng.integers(1, qlen)
+            hmm_to = rng.integers(hmm_from, qlen + 1)
+            ali_from = rng.integers(1, tlen)
+            ali_to = rng.integers(ali_from, tlen + 1)
+            outf.write('%-20s %-10s %5d %-20s %-10s %5d %9.2g %6.1f %5.1f %3d %3d %9.2g %9.2g %6.1f %5.1f %5d %5d %5d %5d %5d %5d %4.2f %s\n' % (
+                'seq_' + str(target), '-', tlen, 'PF' + str(query).zfill(5) + '.1', 'PF' + str(query).zfill(5) + '.1',
+                qlen, evalues[i], scores[i], 0.1, 1, 1, evalues[i], evalues[i] * 10, scores[i] * 0.9, 0.0,
+                hmm_from, hmm_to, ali_from, ali_to, max(1, ali_from - 2), min(tlen, ali_to + 2), 0.95,
+                'hypothetical protein ' + str(target)))
+    return output_file
+
+
+def write_mmseqs_search(output_file, num_hits = 1000000, num_queries = 50000, num_targets = 200000, seed = 0):
+    """Writes a random MMseqs convertalis table in the default 12-column BLAST tab format
+
+    Args:
+        output_file (str): Path to output table
+        num_hits (int, optional): Number of rows. Defaults to 1000000.
+        num_queries (int, optional): Number of distinct queries. Defaults to 50000.
+        num_targets (int, optional): Number of distinct targets. Defaults to 200000.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        str: output_file
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.sort(rng.integers(0, num_queries, num_hits))
+    targets = rng.integers(0, num_targets, num_hits)
+    identities = rng.uniform(0.2, 1.0, num_hits)
+    lengths = rng.integers(30, 800, num_hits)
+    mismatches = (lengths * (1 - identities)).astype(np.int64)
+    gaps = rng.integers(0, 10, num_hits)
+    starts = rng.integers(1, 200, (2, num_hits))
+    evalues = 10.0 ** -rng.uniform(0, 100, num_hits)
+    bitscores = rng.uniform(20, 1500, num_hits)
+    with open(output_file, 'w') as outf:
+        for i in range(num_hits):
+            outf.write('q%d\tt%d\t%.3f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%.3g\t%.1f\n' % (
+                queries[i], targets[i], identities[i], lengths[i], mismatches[i], gaps[i],
+                starts[0, i], starts[0, i] + lengths[i] - 1, starts[1, i], starts[1, i] + lengths[i] - 1,
+                evalues[i], bitscores[i]))
+    return output_file
@@ -0,0 +1,72 @@
+"""Measures how long importing each bioutils module takes in a fresh interpreter
+
+Run from the repository root:
+
+    python -m benchmarks.import_time --output import_results.json
+    python -m benchmarks.run_benchmarks compare import_baseline.json import_results.json
+
+Each module is imported in its own subprocess, repeatedly, and the fastest time is reported along
+with the child's peak RSS and which heavy dependencies were actually loaded. Results use the same
+format as run_benchmarks, so its compare command works on them.
+"""
+import os, sys, json, time, platform, argparse, subprocess
+
+MODULES = [
+    'bioutils.fasta_ops', 'bioutils.faidx', 'bioutils.seq_stats', 'bioutils.tables', 'bioutils.bam_ops',
+    'bioutils.sketch', 'bioutils.genome', 'bioutils.run_external.run_hmmer', 'bioutils.run_external.run_prodigal',
+    'bioutils.run_external.run_mmseqs', 'bioutils.run_external.run_checkm', 'bioutils.run_external.engine',
+]
+# Dependencies worth deferring, reported when an import really loads them
+HEAVY_MODULES = ['numpy', 'pysam', 'Bio', 'distutils', 'asyncio', 'pandas']
+_CHILD = '''
+import sys, time, types, resource
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if type(sys.modules.get(name)) is types.ModuleType]
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, ','.join(heavy))
+'''
+
+
+def time_import(module, repeats = 5):
+    """Imports a module in fresh interpreters
+
+    Returns:
+        dict: seconds_min, seconds_median, seconds (every repeat), peak_bytes and heavy_modules_loaded
+    """
+    timings = []
+    code = _CHILD.format(module = module, heavy = HEAVY_MODULES)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], stdout = subprocess.PIPE, env = env, check = True)
+        seconds, max_rss, heavy = (output.stdout.decode().strip().split(' ') + [''])[:3]
+        timings.append(float(seconds))
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak_bytes = int(max_rss) if sys.platform == 'darwin' else int(max_rss) * 1024
+    timings.sort()
+    return {'seconds_min': timings[0], 'seconds_median': timings[len(timings) // 2], 'seconds': timings,
+            'peak_bytes': peak_bytes, 'heavy_modules_loaded': [name for name in heavy.split(',') if name]}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Import time of bioutils modules')
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--output', default = 'import_results.json')
+    parser.add_argument('modules', nargs = '*', default = MODULES)
+    args = parser.parse_args(argv)
+    results = {}
+    for module in args.modules:
+        results[module] = time_import(module, args.repeats)
+        print('%-40s %8.1f ms %8.1f MiB  %s' % (module, results[module]['seconds_min'] * 1000,
+                                              results[module]['peak_bytes'] / 2 ** 20,
+                                              ' '.join(results[module]['heavy_modules_loaded'])), file = sys.stderr)
+    metadata = {'scale': 'import', 'repeats': args.repeats, 'created': time.time(),
+                'python': platform.python_version(), 'platform': platform.platform()}
+    with open(args.output, 'w') as outf:
+        json.dump({'metadata': metadata, 'results': results}, outf, indent = 2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""Times and measures peak memory of bioutils' FASTA functions and hit parsers on synthetic data
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks run --scale small --output results.json
+    python -m benchmarks.run_benchmarks compare baseline.json results.json --threshold 0.1
+
+Each benchmark is timed over several repeats (the fastest is reported, as it is the least
+disturbed by other load), then run once more under tracemalloc for its peak Python/NumPy
+allocation. compare exits with status 1 if any benchmark got slower or bigger than the threshold.
+"""
+import os, re, gc, sys, json, time, platform, argparse, resource, subprocess, tracemalloc
+import numpy as np
+from benchmarks import generate
+from bioutils import fasta_ops, seq_stats, sketch
+from bioutils.tables import ColumnarTable
+from bioutils.run_external.run_hmmer import HmmsearchParser
+from bioutils.run_external.run_mmseqs import MmseqsParser
+
+# Sizes of the synthetic inputs for each scale
+SCALES = {
+    'small': {'fasta_records': 2000, 'mean_length': 5000, 'hmm_hits': 20000, 'mmseqs_hits': 100000},
+    'medium': {'fasta_records': 20000, 'mean_length': 5000, 'hmm_hits': 200000, 'mmseqs_hits': 1000000},
+    'large': {'fasta_records': 100000, 'mean_length': 10000, 'hmm_hits': 2000000, 'mmseqs_hits': 10000000},
+}
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Registers a benchmark. The decorated function does any setup and returns the callable to measure"""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def consume(iterator):
+    """Exhausts an iterator, returning how many items it yielded"""
+    count = 0
+    for item in iterator:
+        count += 1
+    return count
+
+
+def generate_data(data_dir, scale = 'small', seed = 0):
+    """Writes the synthetic inputs for a scale, reusing files from earlier runs
+
+    Returns:
+        dict: Input name: path
+    """
+    sizes = SCALES[scale]
+    os.makedirs(data_dir, exist_ok = True)
+    prefix = os.path.join(data_dir, scale + '_' + str(seed) + '_')
+    data = {
+        'nucleotide_fasta': prefix + 'contigs.fna',
+        'nucleotide_fasta_gz': prefix + 'contigs.fna.gz',
+        'protein_fasta': prefix + 'proteins.faa',
+        'domtblout': prefix + 'hits.domtblout',
+        'mmseqs_search': prefix + 'search.m8',
+    }
+    if not os.path.exists(data['nucleotide_fasta']):
+        generate.write_fasta(data['nucleotide_fasta'], sizes['fasta_records'], sizes['mean_length'], seed = seed)
+    if not os.path.exists(data['nucleotide_fasta_gz']):
+        fasta_ops.write_fasta(fasta_ops._iter_fasta_bytes(data['nucleotide_fasta']), data['nucleotide_fasta_gz'],
+                              line_width = 80)
+    if not os.path.exists(data['protein_fasta']):
+        generate.write_fasta(data['protein_fasta'], sizes['fasta_records'], 300, sigma = 0.5, alphabet = 'protein',
+                             line_width = 60, seed = seed)
+    if not os.path.exists(data['domtblout']):
+        generate.write_domtblout(data['domtblout'], sizes['hmm_hits'], sizes['fasta_records'], seed = seed)
+    if not os.path.exists(data['mmseqs_search']):
+        generate.write_mmseqs_search(data['mmseqs_search'], sizes['mmseqs_hits'], sizes['fasta_records'], seed = seed)
+    data['work_dir'] = data_dir
+    return data
+
+
+@benchmark('fasta_ops.iter_fasta')
+def bench_iter_fasta(data):
+    return lambda: consume(fasta_ops.iter_fasta(data['nucleotide_fasta']))
+
+
+@benchmark('fasta_ops.read_fasta')
+def bench_read_fasta(data):
+    return lambda: fasta_ops.read_fasta(data['nucleotide_fasta'])
+
+
+@benchmark('fasta_ops.read_fasta[bgzf]')
+def bench_read_fasta_bgzf(data):
+    return lambda: fasta_ops.read_fasta(data['nucleotide_fasta_gz'])
+
+
+@benchmark('fasta_ops.read_fasta[protein]')
+def bench_read_fasta_protein(data):
+    return lambda: fasta_ops.read_fasta(data['protein_fasta'])
+
+
+@benchmark('fasta_ops.check_fasta_type')
+def bench_check_fasta_type(data):
+    return lambda: fasta_ops.check_fasta_type(data['protein_fasta'])
+
+
+@benchmark('fasta_ops.iter_subset_fasta')
+def bench_iter_subset_fasta(data):
+    headers = [header for i, (header, sequence) in enumerate(fasta_ops.iter_fasta(data['nucleotide_fasta'])) if i % 10 == 0]
+    return lambda: consume(fasta_ops.iter_subset_fasta(data['nucleotide_fasta'], headers))
+
+
+@benchmark('fasta_ops.fetch_fasta')
+def bench_fetch_fasta(data):
+    headers = [header for i, (header, sequence) in enumerate(fasta_ops.iter_fasta(data['nucleotide_fasta'])) if i % 10 == 0]
+    # Builds the .fai once, so repeats time indexed lookups only
+    consume(fasta_ops.fetch_fasta(data['nucleotide_fasta'], headers[:1]))
+    return lambda: consume(fasta_ops.fetch_fasta(data['nucleotide_fasta'], headers))
+
+
+@benchmark('fasta_ops.iter_filter_fasta')
+def bench_iter_filter_fasta(data):
+    return lambda: consume(fasta_ops.iter_filter_fasta(data['nucleotide_fasta'], 5000))
+
+
+@benchmark('fasta_ops.write_fasta')
+def bench_write_fasta(data):
+    records = fasta_ops.read_fasta(data['nucleotide_fasta'])
+    return lambda: fasta_ops.write_fasta(records, os.path.join(data['work_dir'], 'write_fasta.fna'), line_width = 80)
+
+
+@benchmark('fasta_ops.write_fasta[bgzf]')
+def bench_write_fasta_bgzf(data):
+    records = fasta_ops.read_fasta(data['nucleotide_fasta'])
+    return lambda: fasta_ops.write_fasta(records, os.path.join(data['work_dir'], 'write_fasta.fna.gz'), line_width = 80)
+
+
+@benchmark('fasta_ops.calculate_n50')
+def bench_calculate_n50(data):
+    return lambda: fasta_ops.calculate_n50(data['nucleotide_fasta'])
+
+
+@benchmark('seq_stats.calculate_stats')
+def bench_calculate_stats(data):
+    return lambda: seq_stats.calculate_stats(data['nucleotide_fasta'])
+
+
+@benchmark('sketch.sketch_fasta')
+def bench_sketch_fasta(data):
+    return lambda: sketch.sketch_fasta(data['nucleotide_fasta'])
+
+
+@benchmark('HmmsearchParser.parse_hmmsearch')
+def bench_parse_hmmsearch(data):
+    return lambda: HmmsearchParser(data['domtblout']).parse_hmmsearch()
+
+
+@benchmark('HmmsearchParser.parse_columnar')
+def bench_parse_columnar(data):
+    return lambda: HmmsearchParser(data['domtblout']).parse_columnar()
+
+
+@benchmark('HmmsearchParser.parse_columnar[best_hit]')
+def bench_parse_columnar_best_hit(data):
+    return lambda: HmmsearchParser(data['domtblout']).parse_columnar(best_hit = True, max_evalue = 1e-10)
+
+
+@benchmark('MmseqsParser.parse_table')
+def bench_mmseqs_parse_table(data):
+    return lambda: MmseqsParser(data['mmseqs_search']).parse_table()
+
+
+@benchmark('MmseqsParser.iter_chunks')
+def bench_mmseqs_iter_chunks(data):
+    return lambda: ColumnarTable.concatenate(MmseqsParser(data['mmseqs_search']).iter_chunks(min_identity = 0.5))
+
+
+@benchmark('MmseqsParser.top_hits')
+def bench_mmseqs_top_hits(data):
+    return lambda: MmseqsParser(data['mmseqs_search']).top_hits(n = 1)
+
+
+def measure(func, repeats = 3):
+    """Times a callable over repeats, then measures its peak traced allocation in one more run
+
+    Returns:
+        dict: seconds_min, seconds_median, seconds (every repeat) and peak_bytes
+    """
+    timings = []
+    for i in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'seconds_min': min(timings), 'seconds_median': float(np.median(timings)), 'seconds': timings,
+            'peak_bytes': peak_bytes}
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                                cwd = os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(scale = 'small', repeats = 3, data_dir = '.benchmark_data', pattern = None, seed = 0):
+    """Runs every registered benchmark whose name matches pattern
+
+    Returns:
+        dict: 'metadata' about the run and 'results' of benchmark name: measurements
+    """
+    data = generate_data(data_dir, scale, seed)
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        results[name] = measure(setup(data), repeats)
+        print('%-45s %9.3fs %10.1f MiB' % (name, results[name]['seconds_min'], results[name]['peak_bytes'] / 2 ** 20),
+              file = sys.stderr)
+    metadata = {
+        'scale': scale, 'repeats': repeats, 'seed': seed, 'created': time.time(), 'commit': _git_commit(),
+        'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+        'cpu_count': os.cpu_count(), 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    return {'metadata': metadata, 'results': results}
+
+
+def compare(baseline, current, threshold = 0.1):
+    """Compares two results files' fastest times and peak memory
+
+    Args:
+        baseline (dict): Results of the reference run
+        current (dict): Results of the new run
+        threshold (float, optional): Relative increase counted as a regression. Defaults to 0.1 (10%).
+
+    Returns:
+        list: (benchmark name, metric, baseline value, current value) for every regression
+    """
+    if baseline['metadata']['scale'] != current['metadata']['scale']:
+        print('Warning: comparing different scales', file = sys.stderr)
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        row = [name]
+        for metric in ('seconds_min', 'peak_bytes'):
+            before = baseline['results'][name][metric]
+            after = current['results'][name][metric]
+            ratio = after / before if before else 1.0
+            flag = ''
+            if ratio > 1 + threshold:
+                regressions.append((name, metric, before, after))
+                flag = ' !'
+            row.append('%6.2fx%s' % (ratio, flag))
+        print('%-45s time %-9s memory %s' % tuple(row))
+    for name in sorted(set(baseline['results']) ^ set(current['results'])):
+        print('%-45s only in %s' % (name, 'baseline' if name in baseline['results'] else 'current'))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks for bioutils')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    run_parser = subparsers.add_parser('run', help = 'Run benchmarks and write a results file')
+    run_parser.add_argument('--scale', choices = sorted(SCALES), default = 'small')
+    run_parser.add_argument('--repeats', type = int, default = 3)
+    run_parser.add_argument('--data-dir', default = '.benchmark_data', help = 'Where synthetic inputs are written and reused')
+    run_parser.add_argument('--filter', default = None, help = 'Only run benchmarks whose name matches this regex')
+    run_parser.add_argument('--seed', type = int, default = 0)
+    run_parser.add_argument('--output', default = 'benchmark_results.json')
+    compare_parser = subparsers.add_parser('compare', help = 'Compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type = float, default = 0.1)
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run_benchmarks(args.scale, args.repeats, args.data_dir, args.filter, args.seed)
+        with open(args.output, 'w') as outf:
+            json.dump(results, outf, indent = 2)
+        return 0
+    with open(args.baseline, 'r') as inf:
+        baseline = json.load(inf)
+    with open(args.current, 'r') as inf:
+        current = json.load(inf)
+    regressions = compare(baseline, current, args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Reading and writing of BGZF (blocked gzip) files, as used by bgzip and samtools
+
+BGZF files are a series of independent gzip members of at most 64 KiB each, so blocks
+can be decompressed in parallel and located by offset without reading the whole file.
+"""
+import io, struct, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BLOCK_HEADER_LEN = 18
+BLOCK_FOOTER_LEN = 8
+# Uncompressed bytes per block written, as in bgzip, leaving room for incompressible data
+MAX_BLOCK_INPUT = 0xff00
+# Empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_bgzf(filepath):
+    """Checks if a file is BGZF-compressed by looking for the BC extra subfield
+
+    Args:
+        filepath (str): Path to file
+
+    Returns:
+        Boolean: True if the first block of the file is a BGZF block, else False
+    """
+    with open(filepath, 'rb') as inf:
+        header = inf.read(BLOCK_HEADER_LEN)
+    return len(header) == BLOCK_HEADER_LEN and header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+def read_raw_block(handle):
+    """Reads one compressed BGZF block from an open binary handle
+
+    Args:
+        handle (file): Binary file handle positioned at the start of a block
+
+    Returns:
+        tuple: (compressed data, uncompressed size, total block size), or None at end of file
+    """
+    header = handle.read(BLOCK_HEADER_LEN)
+    if not header:
+        return None
+    if len(header) < BLOCK_HEADER_LEN or header[:4] != BGZF_MAGIC:
+        raise ValueError('Invalid BGZF block header at offset ' + str(handle.tell() - len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+    # Skip any extra subfields beyond BC, which is always 6 bytes
+    remaining = handle.read(block_size - BLOCK_HEADER_LEN)
+    cdata = remaining[xlen - 6:-BLOCK_FOOTER_LEN]
+    isize = struct.unpack('<I', remaining[-4:])[0]
+    return cdata, isize, block_size
+
+
+def decompress_block(cdata):
+    """Decompresses the raw deflate payload of one BGZF block"""
+    return zlib.decompress(cdata, -15)
+
+
+class BgzfReader(io.RawIOBase):
+    """Read-only binary stream over a BGZF file that decompresses blocks in parallel
+
+    zlib releases the GIL while inflating, so a thread pool gives real parallel speedup.
+    """
+    def __init__(self, filepath, threads = 1, blocks_per_batch = 64):
+        """Opens a BGZF file for streaming
+
+        Args:
+            filepath (str): Path to BGZF file
+            threads (int, optional): Number of decompression threads. Defaults to 1.
+            blocks_per_batch (int, optional): Blocks read and decompressed per batch. Defaults to 64.
+        """
+        super().__init__()
+        self.handle = open(filepath, 'rb')
+        self.threads = max(1, threads)
+        self.blocks_per_batch = blocks_per_batch
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self._buffer = b''
+        self._pos = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        cdatas = []
+        while len(cdatas) < self.blocks_per_batch:
+            block = read_raw_block(self.handle)
+            if block is None:
+                self._eof = True
+                break
+            cdatas.append(block[0])
+        if self.executor is not None:
+            decompressed = self.executor.map(decompress_block, cdatas)
+        else:
+            decompressed = map(decompress_block, cdatas)
+        self._buffer = b''.join(decompressed)
+        self._pos = 0
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            if self._eof:
+                return 0
+            self._fill()
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.handle.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        super().close()
+
+
+def compress_block(data, level = 6):
+    """Compresses up to MAX_BLOCK_INPUT bytes into one complete BGZF block
+
+    Args:
+        data (bytes): Uncompressed data
+        level (int, optional): zlib compression level. Defaults to 6.
+
+    Returns:
+        bytes: BGZF block including header and footer
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) + BLOCK_HEADER_LEN + BLOCK_FOOTER_LEN > 65536:
+        # Incompressible input can grow past the block size limit, so store it instead
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    block_size = len(cdata) + BLOCK_HEADER_LEN + BLOCK_FOOTER_LEN
+    header = BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', block_size - 1)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    """Write-only binary stream that compresses BGZF blocks in parallel
+
+    Output can be read by any gzip reader, and indexed by samtools faidx and bioutils.faidx.
+    """
+    def __init__(self, filepath, threads = 1, level = 6, blocks_per_batch = 64):
+        """Opens a BGZF file for writing
+
+        Args:
+            filepath (str): Path to output file
+            threads (int, optional): Number of compression threads. Defaults to 1.
+            level (int, optional): zlib compression level. Defaults to 6.
+            blocks_per_batch (int, optional): Blocks buffered and compressed per batch. Defaults to 64.
+        """
+        super().__init__()
+        self.handle = open(filepath, 'wb')
+        self.threads = max(1, threads)
+        self.level = level
+        self.batch_size = blocks_per_batch * MAX_BLOCK_INPUT
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        if len(self._buffer) >= self.batch_size:
+            self._flush_blocks(final = False)
+        return len(b)
+
+    def _flush_blocks(self, final):
+        end = len(self._buffer) if final else len(self._buffer) - len(self._buffer) % MAX_BLOCK_INPUT
+        chunks = [bytes(self._buffer[start:start + MAX_BLOCK_INPUT]) for start in range(0, end, MAX_BLOCK_INPUT)]
+        del self._buffer[:end]
+        if self.executor is not None:
+            blocks = self.executor.map(compress_block, chunks, [self.level] * len(chunks))
+        else:
+            blocks = (compress_block(chunk, self.level) for chunk in chunks)
+        for block in blocks:
+            self.handle.write(block)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._flush_blocks(final = True)
+                self.handle.write(BGZF_EOF)
+            finally:
+                self.handle.close()
+                if self.executor is not None:
+                    self.executor.shutdown()
+        super().close()
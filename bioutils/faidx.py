@@ -0,0 +1,261 @@
+"""samtools-compatible FASTA index (.fai, plus .gzi for BGZF files) for random access to records
+
+The .fai file has one line per record: name, length, offset of the first base, bases per line
+and bytes per line. For BGZF-compressed FASTAs, offsets are in uncompressed coordinates and the
+.gzi file maps uncompressed offsets to the start of each compressed block.
+"""
+import os, mmap, struct
+from bisect import bisect_right
+from collections import namedtuple
+from bioutils import bgzf
+
+FaidxEntry = namedtuple('FaidxEntry', ['name', 'length', 'offset', 'line_bases', 'line_width'])
+
+
+def parse_region(region):
+    """Parses a samtools-style region string
+
+    Args:
+        region (str): Region as name, name:start or name:start-end (1-based, inclusive)
+
+    Returns:
+        tuple: (name, start, end) with 0-based half-open coordinates, start and end may be None
+    """
+    name, sep, coords = region.rpartition(':')
+    if not sep:
+        return region, None, None
+    coords = coords.replace(',', '')
+    start, dash, end = coords.partition('-')
+    try:
+        start = int(start) - 1
+        end = int(end) if end else None
+    except ValueError:
+        return region, None, None
+    return name, max(start, 0), end
+
+
+def _scan_lines(lines):
+    """Builds index entries from an iterable of binary lines, tracking uncompressed offsets"""
+    entries = []
+    name = None
+    offset = 0
+    seq_offset = length = line_bases = line_width = 0
+    short_line_seen = False
+    for line in lines:
+        if line.startswith(b'>'):
+            if name is not None:
+                entries.append(FaidxEntry(name, length, seq_offset, line_bases, line_width))
+            fields = line[1:].split(None, 1)
+            name = fields[0].decode() if fields else ''
+            seq_offset = offset + len(line)
+            length = line_bases = line_width = 0
+            short_line_seen = False
+        elif name is not None:
+            bases = len(line.rstrip(b'\r\n'))
+            if bases:
+                if short_line_seen:
+                    raise ValueError('Different line lengths within record ' + name + ', cannot index')
+                if line_bases == 0:
+                    line_bases, line_width = bases, len(line)
+                elif bases > line_bases:
+                    raise ValueError('Different line lengths within record ' + name + ', cannot index')
+                elif bases < line_bases:
+                    short_line_seen = True
+                length += bases
+            else:
+                short_line_seen = length > 0
+        offset += len(line)
+    if name is not None:
+        entries.append(FaidxEntry(name, length, seq_offset, line_bases, line_width))
+    return entries
+
+
+def _bgzf_lines(input_fasta, block_offsets):
+    """Yields decompressed lines of a BGZF file, recording (compressed, uncompressed) block offsets"""
+    uoffset = 0
+    remainder = b''
+    with open(input_fasta, 'rb') as inf:
+        while True:
+            coffset = inf.tell()
+            block = bgzf.read_raw_block(inf)
+            if block is None:
+                break
+            cdata, isize, block_size = block
+            if isize == 0:
+                continue
+            block_offsets.append((coffset, uoffset))
+            uoffset += isize
+            data = remainder + bgzf.decompress_block(cdata)
+            lines = data.split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+    if remainder:
+        yield remainder
+
+
+def build_index(input_fasta):
+    """Builds and writes a .fai index (and .gzi for BGZF input) next to a FASTA
+
+    Args:
+        input_fasta (str): Path to uncompressed or BGZF-compressed FASTA
+
+    Returns:
+        list: FaidxEntry for every record
+    """
+    if input_fasta.endswith(('.gz', '.bgz')):
+        if not bgzf.is_bgzf(input_fasta):
+            raise ValueError(input_fasta + ' is gzip but not BGZF compressed, so cannot be indexed. Recompress with bgzip')
+        block_offsets = []
+        entries = _scan_lines(_bgzf_lines(input_fasta, block_offsets))
+        write_gzi(input_fasta + '.gzi', block_offsets)
+    else:
+        with open(input_fasta, 'rb') as inf:
+            entries = _scan_lines(inf)
+    write_fai(input_fasta + '.fai', entries)
+    return entries
+
+
+def write_fai(fai_path, entries):
+    with open(fai_path, 'w') as outf:
+        for entry in entries:
+            outf.write('\t'.join(str(field) for field in entry) + '\n')
+
+
+def read_fai(fai_path):
+    entries = []
+    with open(fai_path, 'r') as inf:
+        for line in inf:
+            fields = line.rstrip('\n').split('\t')
+            entries.append(FaidxEntry(fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4])))
+    return entries
+
+
+def write_gzi(gzi_path, block_offsets):
+    """Writes a bgzip .gzi index. The first block, at offset (0, 0), is implicit"""
+    offsets = [pair for pair in block_offsets if pair != (0, 0)]
+    with open(gzi_path, 'wb') as outf:
+        outf.write(struct.pack('<Q', len(offsets)))
+        for coffset, uoffset in offsets:
+            outf.write(struct.pack('<QQ', coffset, uoffset))
+
+
+def read_gzi(gzi_path):
+    with open(gzi_path, 'rb') as inf:
+        count = struct.unpack('<Q', inf.read(8))[0]
+        values = struct.unpack('<' + str(count * 2) + 'Q', inf.read(count * 16))
+    return [(0, 0)] + list(zip(values[0::2], values[1::2]))
+
+
+def _index_is_current(input_fasta, index_path):
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(input_fasta)
+
+
+class FastaIndex(object):
+    """Random access to records of an indexed FASTA
+
+    Uncompressed FASTAs are memory-mapped, so fetching a record only touches the pages it
+    lives on. BGZF FASTAs are read block by block starting from the nearest .gzi entry.
+    """
+    def __init__(self, input_fasta, rebuild = False):
+        """Loads the .fai (and .gzi) index for a FASTA, building it if missing or out of date
+
+        Args:
+            input_fasta (str): Path to uncompressed or BGZF-compressed FASTA
+            rebuild (bool, optional): Always rebuild the index. Defaults to False.
+        """
+        self.input_fasta = input_fasta
+        self.is_bgzf = bgzf.is_bgzf(input_fasta)
+        fai_path = input_fasta + '.fai'
+        gzi_path = input_fasta + '.gzi'
+        stale = not _index_is_current(input_fasta, fai_path)
+        if self.is_bgzf:
+            stale = stale or not _index_is_current(input_fasta, gzi_path)
+        if rebuild or stale:
+            entries = build_index(input_fasta)
+        else:
+            entries = read_fai(fai_path)
+        self.entries = {entry.name: entry for entry in entries}
+        self.handle = open(input_fasta, 'rb')
+        if self.is_bgzf:
+            self.blocks = read_gzi(gzi_path)
+            self.block_uoffsets = [uoffset for coffset, uoffset in self.blocks]
+            self.mmap = None
+        elif os.path.getsize(input_fasta) > 0:
+            self.mmap = mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.mmap = None
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def keys(self):
+        return self.entries.keys()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.handle.close()
+
+    def _read_uncompressed(self, start, end):
+        """Reads bytes [start, end) in uncompressed file coordinates"""
+        if not self.is_bgzf:
+            return self.mmap[start:end]
+        block_idx = bisect_right(self.block_uoffsets, start) - 1
+        coffset, uoffset = self.blocks[block_idx]
+        self.handle.seek(coffset)
+        chunks = []
+        covered = uoffset
+        while covered < end:
+            block = bgzf.read_raw_block(self.handle)
+            if block is None:
+                break
+            chunks.append(bgzf.decompress_block(block[0]))
+            covered += block[1]
+        data = b''.join(chunks)
+        return data[start - uoffset:end - uoffset]
+
+    def fetch(self, name, start = None, end = None):
+        """Fetches a record or a slice of it
+
+        Args:
+            name (str): Record name (first word of header)
+            start (int, optional): 0-based start of slice. Defaults to None, the start of the record.
+            end (int, optional): 0-based exclusive end of slice. Defaults to None, the end of the record.
+
+        Returns:
+            str: Sequence
+        """
+        entry = self.entries[name]
+        start = 0 if start is None else max(0, start)
+        end = entry.length if end is None else min(end, entry.length)
+        if start >= end:
+            return ''
+        byte_start = entry.offset + (start // entry.line_bases) * entry.line_width + start % entry.line_bases
+        last = end - 1
+        byte_end = entry.offset + (last // entry.line_bases) * entry.line_width + last % entry.line_bases + 1
+        raw = self._read_uncompressed(byte_start, byte_end)
+        return raw.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def fetch_region(self, region):
+        """Fetches a samtools-style region, e.g. contig_1:100-200 (1-based, inclusive)"""
+        name, start, end = parse_region(region)
+        if name not in self.entries and region in self.entries:
+            name, start, end = region, None, None
+        return self.fetch(name, start, end)
+
+    def fetch_many(self, names):
+        """Yields (name, sequence) for each requested name present in the index, in request order"""
+        for name in names:
+            if name in self.entries:
+                yield name, self.fetch(name)
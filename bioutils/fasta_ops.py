@@ -1,82 +1,278 @@
-from Bio import SeqIO
-from bioutils import utilities
-import itertools
+from bioutils import utilities, faidx
+from concurrent.futures import ProcessPoolExecutor
+import os, itertools, functools
 
+FASTA_EXTENSIONS = ('.fna', '.fa', '.fasta', '.fas', '.fna.gz', '.fa.gz', '.fasta.gz')
+NUCLEOTIDE_BASES = 'ACGTUN'
+AMINO_BASES = 'ACDEFGHIKLMNPQRSTVWY'
 
-def read_fasta(input_fasta):
+
+@functools.lru_cache(maxsize = None)
+def _alphabet_lut(bases):
+    """Builds a 256-entry table that is 1 for bytes in an alphabet (either case), else 0"""
+    import numpy as np
+    lut = np.zeros(256, dtype = np.int64)
+    for base in bases.upper() + bases.lower():
+        lut[ord(base)] = 1
+    return lut
+
+
+def iter_fasta(input_fasta, threads = 1):
+    """Lazily reads a FASTA file, yielding (header, sequence) tuples one record at a time
+
+    Only the record currently being parsed is held in memory, so this can be used on
+    files much larger than available RAM. Headers are trimmed to the first word, matching
+    the IDs that read_fasta returns. Gzip, BGZF and tar.gz inputs are decompressed on the fly.
+
+    Args:
+        input_fasta (str): Path to input FASTA
+        threads (int, optional): Number of decompression threads for compressed input. Defaults to 1.
+
+    Yields:
+        tuple: (header, sequence) strings for each record
+    """
+    for header, sequence in _iter_fasta_bytes(input_fasta, threads):
+        yield header.decode(), sequence.decode()
+
+
+def _iter_fasta_bytes(input_fasta, threads = 1):
+    """Yields (header, sequence) bytes for each record, without decoding"""
+    with utilities.open_compressed(input_fasta, threads) as handle:
+        yield from _parse_fasta_lines(handle)
+
+
+def _parse_fasta_lines(lines):
+    """Yields (header, sequence) bytes from an iterable of binary FASTA lines"""
+    header = None
+    seq_lines = []
+    for line in lines:
+        if line.startswith(b'>'):
+            if header is not None:
+                yield header, b''.join(seq_lines)
+            fields = line[1:].split(None, 1)
+            header = fields[0] if fields else b''
+            seq_lines = []
+        elif header is not None:
+            seq_lines.append(line.rstrip())
+    if header is not None:
+        yield header, b''.join(seq_lines)
+
+
+def read_fasta(input_fasta, threads = 1):
     """Reads a FASTA file and returns a dict of header: sequence"""
-    fasta_dict = {}
-    if input_fasta.endswith('.gz'):
-        infasta = utilities.unpack_file(input_fasta)
+    return dict(iter_fasta(input_fasta, threads))
+
+
+def _create_temp_file(output_dir, output_name):
+    """Creates an empty, uniquely named hidden file next to an output, with the permissions open() would give
+
+    Unlike tempfile.mkstemp, which makes files readable only by the owner, the file is created with
+    mode 0o666 so the process umask applies.
+    """
+    while True:
+        tmp_path = os.path.join(output_dir, '.' + output_name + '.' + os.urandom(6).hex())
+        try:
+            os.close(os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        except FileExistsError:
+            continue
+        return tmp_path
+
+
+def write_fasta(input_dict, output_file, line_width = None, compression = 'auto', threads = 1,
+                buffer_size = 4 * 1024 * 1024):
+    """Writes a FASTA given a dict of header: sequence, or an iterable of (header, sequence) tuples
+
+    Iterables are written as they are consumed, so the output of iter_fasta,
+    iter_subset_fasta and iter_filter_fasta can be piped straight in. Headers and sequences may
+    be str or bytes. Records are joined into large buffers before each write, and the file is
+    written to a temporary name and renamed into place, so output_file is replaced (never
+    appended to) and is never left half-written.
+
+    Args:
+        input_dict (dict or iterable): header: sequence dict, or (header, sequence) tuples
+        output_file (str): Path to output FASTA
+        line_width (int, optional): Wrap sequences to lines of this many characters. Defaults to None, no wrapping.
+        compression (str, optional): 'bgzf', 'gzip', None, or 'auto' for BGZF when output_file ends
+            in .gz or .bgz, else uncompressed. Defaults to 'auto'.
+        threads (int, optional): Number of compression threads. Defaults to 1.
+        buffer_size (int, optional): Bytes buffered before each write. Defaults to 4 MiB.
+    """
+    if isinstance(input_dict, dict):
+        records = input_dict.items()
     else:
-        infasta = input_fasta
-    for seqrecord in SeqIO.parse(input_fasta, "fasta"):
-        seqid = str(seqrecord.id)
-        sequence = str(seqrecord.seq)
-        fasta_dict[seqid] = sequence
-    return fasta_dict
-
-
-def write_fasta(input_dict, output_file):
-    """Writes a FASTA given a dict of header: sequence"""
-    with open(output_file, 'a+') as outf:
-        for header, sequence in input_dict.values():
-            outf.write('>' + header + '\n' + sequence + '\n')
-            
-
-def check_fasta_type(input_fasta):
-    """Reads a FASTA and checks if it's a protein or nucleotide fasta
-    
-    This is done by subsampling 10 sequences from the input FASTA, then checking if 
-    base counts are above 90% sameness to nucleotide/amino acid alphabets
-    
-    Returns str: 'nucleotide', 'protein', or 'unknown'
+        records = input_dict
+    if compression == 'auto':
+        compression = 'bgzf' if output_file.endswith(('.gz', '.bgz')) else None
+    output_dir, output_name = os.path.split(os.path.abspath(output_file))
+    tmp_path = _create_temp_file(output_dir, output_name)
+    try:
+        with utilities.open_compressed_writer(tmp_path, compression, threads) as outf:
+            parts = []
+            buffered = 0
+            for header, sequence in records:
+                if isinstance(header, str):
+                    header = header.encode()
+                if isinstance(sequence, str):
+                    sequence = sequence.encode()
+                if line_width and len(sequence) > line_width:
+                    sequence = b'\n'.join(sequence[i:i + line_width] for i in range(0, len(sequence), line_width))
+                parts.append(b'>' + header + b'\n' + sequence + b'\n')
+                buffered += len(parts[-1])
+                if buffered >= buffer_size:
+                    outf.write(b''.join(parts))
+                    parts = []
+                    buffered = 0
+            outf.write(b''.join(parts))
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def check_fasta_type(input_fasta, max_records = 10, max_bytes = 1024 * 1024):
+    """Reads the start of a FASTA and checks if it's a protein or nucleotide fasta
+
+    Only the first max_bytes of (decompressed) input are read, and at most max_records
+    sequences from that are classified. A sequence counts as nucleotide if 90% or more of it is
+    ACGTUN, otherwise as protein if 90% or more is standard amino acids. The file is called
+    when 80% or more of sampled sequences agree.
+
+    Args:
+        input_fasta (str): Path to input FASTA
+        max_records (int, optional): Maximum number of sequences to sample. Defaults to 10.
+        max_bytes (int, optional): Maximum number of bytes to read. Defaults to 1 MiB.
+
+    Returns:
+        str: 'nucleotide', 'protein', or 'unknown'
     """
-    fasta_dict = read_fasta(input_fasta)
-    subsample = dict(itertools.islice(fasta_dict.items(), 10))
-    nuc_bases = ['A', 'T', 'G', 'C']
-    amino_bases = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
-    nuc_seqs = 0
-    prot_seqs = 0
-    for header, sequence in subsample.items():
-        seq_len = len(sequence)
-        number_nucleotide_bases = 0
-        number_amino_bases = 0
-        for base in nuc_bases:
-            number_nucleotide_bases += sequence.count(base)
-        for base in amino_bases:
-            number_amino_bases += sequence.count(base)
-        proportion_nucleotide = number_nucleotide_bases/seq_len
-        proportion_amino = number_amino_bases/seq_len
-        if proportion_nucleotide >= 0.9:
-            nuc_seqs += 1
-        elif proportion_amino >= 0.9:
-            prot_seqs += 1
-        if nuc_seqs >= 8:
-            return "nucleotide"
-        elif prot_seqs >= 8:
-            return "protein"
-        else:
-            return "unknown"
-    
-
-def subset_fasta(input_fasta, sequence_headers):
-    """Subsets a FASTA from an input FASTA using a list of wanted headers"""
-    fasta_dict = read_fasta(input_fasta)
-    subset_dict = {header: sequence for header, sequence in fasta_dict.items() if header in sequence_headers}
-    return subset_dict
+    import numpy as np
+    with utilities.open_compressed(input_fasta) as handle:
+        prefix = handle.read(max_bytes)
+    sequences = [sequence for header, sequence in
+                 itertools.islice(_parse_fasta_lines(prefix.splitlines(keepends = True)), max_records)
+                 if sequence]
+    if not sequences:
+        return "unknown"
+    seq_lens = np.array([len(sequence) for sequence in sequences])
+    seq_bytes = np.frombuffer(b''.join(sequences), dtype = np.uint8)
+    seq_ids = np.repeat(np.arange(len(sequences)), seq_lens)
+    proportion_nucleotide = np.bincount(seq_ids, weights = _alphabet_lut(NUCLEOTIDE_BASES)[seq_bytes], minlength = len(sequences)) / seq_lens
+    proportion_amino = np.bincount(seq_ids, weights = _alphabet_lut(AMINO_BASES)[seq_bytes], minlength = len(sequences)) / seq_lens
+    is_nucleotide = proportion_nucleotide >= 0.9
+    is_protein = ~is_nucleotide & (proportion_amino >= 0.9)
+    if is_nucleotide.sum() >= 0.8 * len(sequences):
+        return "nucleotide"
+    elif is_protein.sum() >= 0.8 * len(sequences):
+        return "protein"
+    return "unknown"
+
+
+def check_fasta_types(input_fastas, processes = None, max_records = 10, max_bytes = 1024 * 1024):
+    """Runs check_fasta_type over many FASTAs in parallel
+
+    Args:
+        input_fastas (list): Paths to input FASTAs
+        processes (int, optional): Number of worker processes. Defaults to None, which uses all cores.
+        max_records (int, optional): Maximum number of sequences to sample per file. Defaults to 10.
+        max_bytes (int, optional): Maximum number of bytes to read per file. Defaults to 1 MiB.
+
+    Returns:
+        dict: input FASTA path: 'nucleotide', 'protein', or 'unknown'
+    """
+    with ProcessPoolExecutor(processes) as executor:
+        results = executor.map(check_fasta_type, input_fastas, itertools.repeat(max_records),
+                               itertools.repeat(max_bytes), chunksize = 16)
+        return dict(zip(input_fastas, results))
+
+
+def _records(input_fasta):
+    """Accepts either a path to a FASTA or an iterable of (header, sequence) tuples"""
+    if isinstance(input_fasta, str):
+        return iter_fasta(input_fasta)
+    return input_fasta
+
+
+def iter_subset_fasta(input_fasta, sequence_headers):
+    """Lazily yields records whose header is in a collection of wanted headers
+
+    Args:
+        input_fasta (str or iterable): Path to input FASTA, or an iterable of (header, sequence) tuples
+        sequence_headers (iterable): Wanted headers
+
+    Yields:
+        tuple: (header, sequence) for each wanted record, in input order
+    """
+    wanted = set(sequence_headers)
+    for header, sequence in _records(input_fasta):
+        if header in wanted:
+            yield header, sequence
+
+
+def iter_filter_fasta(input_fasta, minimum_len):
+    """Lazily yields records with length greater than or equal to minimum
+
+    Args:
+        input_fasta (str or iterable): Path to input FASTA, or an iterable of (header, sequence) tuples
+        minimum_len (int): Minimum sequence length to keep
+
+    Yields:
+        tuple: (header, sequence) for each record passing the length filter
+    """
+    for header, sequence in _records(input_fasta):
+        if len(sequence) >= minimum_len:
+            yield header, sequence
+
+
+def fetch_fasta(input_fasta, sequence_headers):
+    """Lazily fetches wanted records from a FASTA through its .fai index
+
+    The index is built once (and a .gzi for BGZF input) and reused while the FASTA is unchanged,
+    so cost scales with the number of records fetched rather than the size of the input.
+    Headers may also be samtools-style regions, e.g. contig_1:100-200.
+
+    Args:
+        input_fasta (str): Path to uncompressed or BGZF-compressed FASTA
+        sequence_headers (iterable): Wanted headers or regions
+
+    Yields:
+        tuple: (header, sequence) for each wanted record found, in request order
+    """
+    with faidx.FastaIndex(input_fasta) as index:
+        for header in sequence_headers:
+            if header in index:
+                yield header, index.fetch(header)
+            elif faidx.parse_region(header)[0] in index:
+                yield header, index.fetch_region(header)
+
+
+def subset_fasta(input_fasta, sequence_headers, indexed = False):
+    """Subsets a FASTA from an input FASTA using a list of wanted headers
+
+    Args:
+        input_fasta (str): Path to input FASTA
+        sequence_headers (iterable): Wanted headers
+        indexed (bool, optional): Fetch records through a .fai index instead of scanning the
+            whole file. Defaults to False.
+
+    Returns:
+        dict: header: sequence for wanted records
+    """
+    if indexed:
+        return dict(fetch_fasta(input_fasta, sequence_headers))
+    return dict(iter_subset_fasta(input_fasta, sequence_headers))
 
 
 def filter_fasta(input_fasta, minimum_len):
     """Subsets FASTA to sequences with length greater than minimum"""
-    fasta_dict = read_fasta(input_fasta)
-    filtered_dict = {header: sequence for header, sequence in fasta_dict.items() if len(sequence) >= minimum_len}
-    return filtered_dict
-    
+    return dict(iter_filter_fasta(input_fasta, minimum_len))
+
 
 def calculate_n50(input_fasta):
     """Calculates the N50 of an input nucleotide FASTA
 
+    Streams the FASTA once; see seq_stats.calculate_stats for N90, L50, GC and other statistics.
+
     Args:
         input_fasta (str): Path to input FASTA
 
@@ -84,17 +280,6 @@ def calculate_n50(input_fasta):
         int: N50, or the smallest contig/scaffold length of contigs
         containing half or more of total sequence length
     """
+    from bioutils import seq_stats
     if check_fasta_type(input_fasta) == "nucleotide":
-        fasta_dict = read_fasta(input_fasta)
-        seq_lengths = []
-        for sequence in fasta_dict.values():
-            seq_len = len(sequence)
-            seq_lengths.append(seq_len)
-        halfsum = sum(seq_lengths)/2
-        cumulative_len = 0
-        sorted_lengths = sorted(seq_lengths, reverse = True)
-        for seq_len in sorted_lengths:
-            cumulative_len += seq_len
-            if cumulative_len >= halfsum:
-                return seq_len
-    
\ No newline at end of file
+        return seq_stats.calculate_stats(input_fasta).n50
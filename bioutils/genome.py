@@ -1,5 +1,402 @@
-import os
+import os, json, shutil, tempfile, functools
+from concurrent.futures import ProcessPoolExecutor
 from bioutils import fasta_ops, utilities
+from bioutils.tables import ColumnarTable
+from bioutils.run_external import cache as result_cache
+
+
+def cached_property(func):
+    """Property computed at most once per genome file version
+
+    Values are kept in memory and in the genome's sidecar cache file, so they survive across
+    processes until the FASTA changes. Values must be JSON serializable.
+    """
+    name = func.__name__
+
+    @property
+    @functools.wraps(func)
+    def wrapper(self):
+        return self._cached(name, lambda: func(self))
+    return wrapper
+
 
 class Genome(object):
-    pass
+    """Handle for one genome FASTA, with lazily computed and cached properties
+
+    Properties are computed on first access and written to a sidecar JSON file (<fasta>.bioutils.json
+    by default) keyed on a hash of the FASTA's content. Tool outputs go in a subdirectory of work_dir
+    named by the same hash. Both are dropped when the file changes.
+    """
+    def __init__(self, fasta_path, cache_path = None, work_dir = None, prodigal = None, hmmer = None, checkm = None):
+        """Initializes with a path to a nucleotide or amino acid FASTA
+
+        Args:
+            fasta_path (str): Path to genome FASTA
+            cache_path (str, optional): Sidecar cache file. Defaults to None, which is <fasta_path>.bioutils.json.
+            work_dir (str, optional): Directory for tool outputs, which are kept in a subdirectory per
+                content hash. Defaults to None, which is <fasta_path>_bioutils.
+            prodigal (Prodigal, optional): Prodigal wrapper used for protein prediction. Defaults to None, a default Prodigal.
+            hmmer (Hmmer, optional): Hmmer wrapper used for HMM searches. Defaults to None, a default Hmmer.
+            checkm (CheckM, optional): CheckM wrapper used for quality. Defaults to None, a default lineage_wf CheckM.
+        """
+        self.fasta_path = fasta_path
+        self.name = utilities.retrieve_basename(fasta_path)
+        self.cache_path = cache_path or fasta_path + '.bioutils.json'
+        self.work_dir = work_dir or fasta_path + '_bioutils'
+        self.prodigal = prodigal
+        self.hmmer = hmmer
+        self.checkm = checkm
+        self._memory = {}
+        self._persisted = None
+        self._file_state = None
+
+    def __repr__(self):
+        return 'Genome(' + repr(self.fasta_path) + ')'
+
+    def _current_state(self):
+        stat = os.stat(self.fasta_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _load(self):
+        """Loads the sidecar cache, dropping it if the FASTA has changed since it was written"""
+        state = self._current_state()
+        if self._persisted is not None and state == self._file_state:
+            return self._persisted
+        persisted = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r') as cachefile:
+                persisted = json.load(cachefile)
+        if persisted.get('state') != state:
+            # Size or mtime changed, so only a content hash can tell if the file really changed
+            fingerprint = result_cache.file_fingerprint(self.fasta_path, full = True)
+            if persisted.get('fingerprint') != fingerprint:
+                if persisted.get('fingerprint'):
+                    # Tool outputs of the old content must not be picked up by wrappers that skip existing outputs
+                    shutil.rmtree(os.path.join(self.work_dir, persisted['fingerprint']), ignore_errors = True)
+                persisted = {'fingerprint': fingerprint, 'values': {}}
+                self._memory = {}
+            persisted['state'] = state
+            self._write(persisted)
+        self._persisted = persisted
+        self._file_state = state
+        return persisted
+
+    def _write(self, persisted):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as cachefile:
+            json.dump(persisted, cachefile)
+        os.replace(tmp_path, self.cache_path)
+
+    def _output_dir(self):
+        """Directory for tool outputs of the FASTA's current content"""
+        output_dir = os.path.join(self.work_dir, self._load()['fingerprint'])
+        os.makedirs(output_dir, exist_ok = True)
+        return output_dir
+
+    def _cached(self, name, compute):
+        persisted = self._load()
+        if name in self._memory:
+            return self._memory[name]
+        if name in persisted['values']:
+            value = persisted['values'][name]
+        else:
+            value = compute()
+            persisted['values'][name] = value
+            self._write(persisted)
+        self._memory[name] = value
+        return value
+
+    def _seed(self, name, value):
+        """Stores a value computed elsewhere, such as in a worker process, as if computed here"""
+        persisted = self._load()
+        if persisted['values'].get(name) != value:
+            persisted['values'][name] = value
+            self._write(persisted)
+        self._memory[name] = value
+
+    def invalidate(self):
+        """Drops every cached value for this genome"""
+        self._memory = {}
+        self._persisted = None
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    @cached_property
+    def stats(self):
+        """Sequence statistics (N50, GC, total length, ...) as a dict, see seq_stats.SequenceStats.as_dict"""
+        from bioutils import seq_stats
+        return seq_stats.calculate_stats(self.fasta_path).as_dict()
+
+    @cached_property
+    def alphabet(self):
+        """'nucleotide', 'protein' or 'unknown'"""
+        return fasta_ops.check_fasta_type(self.fasta_path)
+
+    @property
+    def proteins(self):
+        """Path to predicted proteins, running Prodigal once if the genome is nucleotide"""
+        if self.alphabet == 'protein':
+            return self.fasta_path
+        output_aa = self._cached('proteins', self._predict_proteins)
+        if not os.path.exists(output_aa):
+            self._forget('proteins')
+            output_aa = self._cached('proteins', self._predict_proteins)
+        return output_aa
+
+    def _predict_proteins(self):
+        if self.prodigal is None:
+            from bioutils.run_external.run_prodigal import Prodigal
+            self.prodigal = Prodigal(verbose = False)
+        output_dir = self._output_dir()
+        output_gbk = os.path.join(output_dir, self.name + '.gbk')
+        output_aa = os.path.join(output_dir, self.name + '.faa')
+        self.prodigal.run_prodigal(self.fasta_path, output_gbk, output_aa)
+        return output_aa
+
+    def _forget(self, name):
+        self._memory.pop(name, None)
+        persisted = self._load()
+        if persisted['values'].pop(name, None) is not None:
+            self._write(persisted)
+
+    def hmm_hits(self, hmm_db, **filters):
+        """Searches predicted proteins against an HMM database once, returning an HmmsearchTable
+
+        Args:
+            hmm_db (str): Path to HMM database
+            **filters: Passed to HmmsearchParser.parse_columnar (best_hit, max_evalue, ...)
+
+        Returns:
+            HmmsearchTable: Hits for this genome
+        """
+        from bioutils.run_external.run_hmmer import Hmmer, HmmsearchParser
+        name = 'hmm_hits:' + os.path.abspath(hmm_db) + ':' + result_cache.path_fingerprint(hmm_db)
+
+        def search():
+            if self.hmmer is None:
+                self.hmmer = Hmmer()
+            output_path = os.path.join(self._output_dir(), self.name + '_' + utilities.retrieve_basename(hmm_db) + '.domtblout')
+            self.hmmer.run_hmmsearch(output_path, self.proteins, hmm_db)
+            return output_path
+        output_path = self._cached(name, search)
+        if not os.path.exists(output_path):
+            self._forget(name)
+            output_path = self._cached(name, search)
+        return HmmsearchParser(output_path).parse_columnar(**filters)
+
+    @cached_property
+    def quality(self):
+        """CheckM quality (completeness, contamination, ...) as a dict of CheckM table columns
+
+        Raises:
+            JobError: If CheckM fails
+            ValueError: If CheckM's table has no row for the genome
+        """
+        from bioutils.run_external.run_checkm import CheckM, CheckMParser
+        if self.checkm is None:
+            self.checkm = CheckM(None)
+        work_dir = self._output_dir()
+        genome_dir = tempfile.mkdtemp(prefix = 'checkm_input_', dir = work_dir)
+        try:
+            os.symlink(os.path.abspath(self.fasta_path), os.path.join(genome_dir, self.name + '.' + self.checkm.genome_type))
+            output_dir = os.path.join(work_dir, 'checkm')
+            output_tsv = os.path.join(work_dir, self.name + '_checkm.tsv')
+            self.checkm.run_checkm_workflow(genome_dir, output_dir, output_tsv)
+        finally:
+            shutil.rmtree(genome_dir, ignore_errors = True)
+        # run_checkm_workflow has already raised JobError if CheckM failed
+        table = next(CheckMParser(output_tsv).iter_chunks(), None)
+        if table is None:
+            raise ValueError('CheckM reported no genomes in ' + output_tsv + ' for ' + self.fasta_path)
+        row = table.row(0)
+        return {name: getattr(row, name) for name in table.column_names}
+
+
+def _genome_stats(fasta_path, cache_path, work_dir):
+    """Computes (or loads cached) stats for one genome in a worker process"""
+    return Genome(fasta_path, cache_path = cache_path, work_dir = work_dir).stats
+
+
+class GenomeCollection(object):
+    """A set of Genomes with a columnar table of per-genome statistics, for batch filtering and tool runs"""
+    def __init__(self, genomes):
+        """Initializes with a directory of FASTAs, or a list of FASTA paths or Genomes
+
+        Args:
+            genomes (str or list): Directory (FASTAs matched by extension) or list of paths/Genomes
+        """
+        if isinstance(genomes, str):
+            genomes = [os.path.join(genomes, fname) for fname in sorted(os.listdir(genomes))
+                       if fname.endswith(fasta_ops.FASTA_EXTENSIONS)]
+        self.genomes = [genome if isinstance(genome, Genome) else Genome(genome) for genome in genomes]
+        self.table = None
+        # Representative name: member names, set on collections returned by dereplicate
+        self.clusters = None
+
+    def __len__(self):
+        return len(self.genomes)
+
+    def __iter__(self):
+        return iter(self.genomes)
+
+    def __getitem__(self, index):
+        return self.genomes[index]
+
+    @property
+    def fasta_paths(self):
+        return [genome.fasta_path for genome in self.genomes]
+
+    def compute_stats(self, processes = None):
+        """Computes sequence statistics for every genome in parallel into self.table
+
+        Stats come from each Genome's sidecar cache when present, so only new or changed genomes
+        are parsed.
+
+        Args:
+            processes (int, optional): Number of worker processes. Defaults to None, all cores.
+
+        Returns:
+            ColumnarTable: One row per genome, with a 'genome' name column and one column per statistic
+        """
+        import numpy as np
+        with ProcessPoolExecutor(processes) as executor:
+            stats = list(executor.map(_genome_stats, self.fasta_paths,
+                                      [genome.cache_path for genome in self.genomes],
+                                      [genome.work_dir for genome in self.genomes], chunksize = 8))
+        for genome, genome_stats in zip(self.genomes, stats):
+            genome._seed('stats', genome_stats)
+        columns = {'genome': np.array([genome.name for genome in self.genomes], dtype = object)}
+        for name in (stats[0] if stats else {}):
+            if name == 'input_fasta':
+                continue
+            values = [row[name] for row in stats]
+            columns[name] = np.array(values, dtype = object if any(value is None for value in values) else None)
+        self.table = ColumnarTable(columns)
+        return self.table
+
+    def add_quality(self, checkm, output_dir):
+        """Runs CheckM once over the whole collection and adds its columns to self.table
+
+        Args:
+            checkm (CheckM): CheckM wrapper
+            output_dir (str): Directory for CheckM outputs
+        """
+        import numpy as np
+        from bioutils.run_external.run_checkm import CheckMParser
+        if self.table is None:
+            self.compute_stats()
+        output_tsv = self.run_checkm(checkm, output_dir)
+        quality = ColumnarTable.concatenate(CheckMParser(output_tsv).iter_chunks())
+        rows = {bin_id: i for i, bin_id in enumerate(quality['bin_id'])} if len(quality) else {}
+        order = np.array([rows.get(name, -1) for name in self.table['genome']], dtype = np.int64)
+        for name in quality.column_names:
+            if name == 'bin_id':
+                continue
+            # Genomes missing from the CheckM table get NaN (floats) or None
+            if quality[name].dtype.kind == 'f':
+                column = np.full(len(order), np.nan)
+            else:
+                column = np.full(len(order), None, dtype = object)
+            column[order >= 0] = quality[name][order[order >= 0]]
+            self.table.columns[name] = column
+        return self.table
+
+    def filter(self, min_total_length = None, max_total_length = None, min_n50 = None, max_sequences = None,
+               min_completeness = None, max_contamination = None):
+        """Returns a new collection of genomes passing size and quality thresholds
+
+        Size filters need compute_stats and quality filters need add_quality to have been run.
+
+        Returns:
+            GenomeCollection: Genomes passing every given threshold, with their rows of self.table
+        """
+        import numpy as np
+        if self.table is None:
+            self.compute_stats()
+        mask = np.ones(len(self), dtype = bool)
+        for name, value, keep in (('total_length', min_total_length, np.greater_equal),
+                                  ('total_length', max_total_length, np.less_equal),
+                                  ('n50', min_n50, np.greater_equal),
+                                  ('num_sequences', max_sequences, np.less_equal),
+                                  ('completeness', min_completeness, np.greater_equal),
+                                  ('contamination', max_contamination, np.less_equal)):
+            if value is not None:
+                mask &= keep(self.table[name].astype(np.float64), value)
+        subset = GenomeCollection([genome for genome, keep in zip(self.genomes, mask) if keep])
+        subset.table = self.table.take(mask)
+        return subset
+
+    def dereplicate(self, ani_threshold = 0.95, k = 21, scaled = 1000, sketch_dir = None, processes = None):
+        """Returns a new collection with one representative per cluster of near-identical genomes
+
+        Genomes are compared with FracMinHash sketches (see bioutils.sketch). Representatives are the
+        highest quality genomes, scored as completeness - 5 * contamination once add_quality has been
+        run, otherwise the largest genomes.
+
+        Args:
+            ani_threshold (float, optional): Minimum estimated ANI to cluster genomes. Defaults to 0.95.
+            k (int, optional): k-mer size. Defaults to 21.
+            scaled (int, optional): Keep about 1 in scaled k-mers. Defaults to 1000.
+            sketch_dir (str, optional): Directory to store and reuse sketches in. Defaults to None.
+            processes (int, optional): Number of worker processes for sketching. Defaults to None, all cores.
+
+        Returns:
+            GenomeCollection: Representatives, with their rows of self.table and clusters set
+        """
+        import numpy as np
+        scores = None
+        if self.table is not None and 'completeness' in self.table.columns:
+            scores = np.nan_to_num(self.table['completeness'].astype(np.float64) -
+                                   5 * self.table['contamination'].astype(np.float64), nan = -np.inf)
+        from bioutils import sketch
+        clusters = sketch.dereplicate(self.fasta_paths, ani_threshold, scores, k, scaled, sketch_dir, processes)
+        index = {fasta_path: i for i, fasta_path in enumerate(self.fasta_paths)}
+        keep = np.array(sorted(index[rep] for rep in clusters), dtype = np.int64)
+        subset = GenomeCollection([self.genomes[i] for i in keep])
+        if self.table is not None:
+            subset.table = self.table.take(keep)
+        subset.clusters = {self.genomes[index[rep]].name: [self.genomes[index[member]].name for member in members]
+                           for rep, members in clusters.items()}
+        return subset
+
+    def batches(self, batch_size):
+        """Yields sub-collections of at most batch_size genomes"""
+        import numpy as np
+        for start in range(0, len(self), batch_size):
+            subset = GenomeCollection(self.genomes[start:start + batch_size])
+            if self.table is not None:
+                subset.table = self.table.take(np.arange(start, min(start + batch_size, len(self))))
+            yield subset
+
+    def link_to_directory(self, directory, extension = None):
+        """Symlinks every genome into one directory, for tools that take a directory of genomes
+
+        Args:
+            directory (str): Directory to create links in
+            extension (str, optional): Extension for the links (e.g. 'fna'). Defaults to None, the original names.
+
+        Returns:
+            str: The directory
+        """
+        os.makedirs(directory, exist_ok = True)
+        for genome in self.genomes:
+            link_name = genome.name + '.' + extension if extension else os.path.basename(genome.fasta_path)
+            link_path = os.path.join(directory, link_name)
+            if not os.path.lexists(link_path):
+                os.symlink(os.path.abspath(genome.fasta_path), link_path)
+        return directory
+
+    def predict_proteins(self, prodigal, output_dir, processes = None, split_size = None):
+        """Runs Prodigal over every genome with Prodigal.run_prodigal_batch
+
+        Returns:
+            dict: FASTA path: (output GBK path, output amino acid FASTA path)
+        """
+        return prodigal.run_prodigal_batch(self.fasta_paths, output_dir, processes, split_size)
+
+    def run_checkm(self, checkm, output_dir):
+        """Runs CheckM once over every genome, returning the path to its table"""
+        genome_dir = self.link_to_directory(os.path.join(output_dir, 'genomes'), checkm.genome_type)
+        output_tsv = os.path.join(output_dir, 'checkm.tsv')
+        checkm.run_checkm_workflow(genome_dir, os.path.join(output_dir, 'checkm'), output_tsv)
+        return output_tsv
@@ -0,0 +1,252 @@
+"""Content-addressed cache of external tool results
+
+A run is keyed on a hash of its input files' contents, the identity of any databases, the tool
+version and the full argument list. Outputs of successful runs are copied into the cache
+directory atomically, so a killed job never leaves an entry that looks complete, and changing a
+parameter or database never reuses stale results.
+"""
+import os, json, glob, time, shutil, hashlib, tempfile
+from bioutils.run_external import instrument
+from bioutils.run_external.path_check import tool_version
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+
+
+def _hasher():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size = 16)
+
+
+def file_fingerprint(filepath, full = False):
+    """Hashes a file's content
+
+    By default only the size and the first, middle and last 1 MiB are hashed, which is enough
+    to tell apart real-world inputs at a fraction of the I/O. Uses xxhash when installed.
+
+    Args:
+        filepath (str): Path to file
+        full (bool, optional): Hash the whole file instead of sampled blocks. Defaults to False.
+
+    Returns:
+        str: Hex digest
+    """
+    hasher = _hasher()
+    size = os.path.getsize(filepath)
+    hasher.update(str(size).encode())
+    with open(filepath, 'rb') as inf:
+        if full or size <= 3 * SAMPLE_BLOCK_SIZE:
+            for block in iter(lambda: inf.read(SAMPLE_BLOCK_SIZE), b''):
+                hasher.update(block)
+        else:
+            for offset in (0, size // 2, size - SAMPLE_BLOCK_SIZE):
+                inf.seek(offset)
+                hasher.update(inf.read(SAMPLE_BLOCK_SIZE))
+    return hasher.hexdigest()
+
+
+def expand_path(path):
+    """Lists the files making up a path: a file, every file in a directory, or every file of an MMseqs database
+
+    MMseqs databases are a prefix (marked by a <prefix>.dbtype file) shared by several files.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, fname) for root, dirs, fnames in os.walk(path) for fname in fnames)
+    files = [path] if os.path.isfile(path) else []
+    if os.path.exists(path + '.dbtype'):
+        files += sorted(set(glob.glob(path + '.*') + glob.glob(path + '_*')))
+    return files
+
+
+def path_fingerprint(path, full = False, exclude = ()):
+    """Hashes the content of a file, directory or MMseqs database, including relative file names
+
+    Args:
+        path (str): File, directory or MMseqs database prefix
+        full (bool, optional): Hash whole files rather than sampled blocks. Defaults to False.
+        exclude (collection, optional): Files to leave out, e.g. outputs written next to an input. Defaults to ().
+
+    Returns:
+        str: Hex digest
+    """
+    hasher = _hasher()
+    base = path if os.path.isdir(path) else os.path.dirname(path)
+    for filepath in expand_path(path):
+        if filepath in exclude:
+            continue
+        hasher.update(os.path.relpath(filepath, base).encode())
+        hasher.update(file_fingerprint(filepath, full).encode())
+    return hasher.hexdigest()
+
+
+def derived_files(path):
+    """Lists files derived from an MMseqs database by createindex (<prefix>.idx*), which don't change its content"""
+    if os.path.exists(path + '.dbtype'):
+        return glob.glob(path + '.idx*')
+    return []
+
+
+def clear_outputs(outputs):
+    """Removes existing output files, so a partial output from an earlier killed run can't be stored"""
+    for output in outputs:
+        if not os.path.isdir(output):
+            for filepath in expand_path(output):
+                os.remove(filepath)
+
+
+class ResultCache(object):
+    """Stores outputs of external tool runs in a directory, keyed on everything that affects them"""
+    def __init__(self, cache_dir, max_bytes = None, full_hash = False):
+        """Initializes with a directory to keep cached outputs in
+
+        Args:
+            cache_dir (str): Cache directory, created if missing
+            max_bytes (int, optional): Maximum total size of cached outputs. The least recently used
+                entries are evicted past this. Defaults to None, no limit.
+            full_hash (bool, optional): Hash whole input files rather than sampled blocks. Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.full_hash = full_hash
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def tool_version(self, tool):
+        """Returns a hash of a tool's version output, which path_check.tool_version probes once per process"""
+        return hashlib.blake2b(tool_version(tool), digest_size = 16).hexdigest()
+
+    def key(self, cmd, outputs, inputs = (), databases = (), ignored = ()):
+        """Computes the cache key for a command
+
+        Input, database and output paths in the command are replaced by placeholders, so the same
+        work on identical content hits the cache wherever the files live. Files of the outputs and
+        MMseqs index files are left out of input and database fingerprints, so a command writing
+        next to its inputs (e.g. createindex) keys the same before and after it has run.
+        """
+        placeholders = {}
+        for label, paths in (('output', outputs), ('input', inputs), ('database', databases), ('ignored', ignored)):
+            for i, path in enumerate(paths):
+                placeholders[path] = '{' + label + str(i) + '}'
+        hasher = hashlib.blake2b(digest_size = 20)
+        hasher.update(self.tool_version(cmd[0]).encode())
+        hasher.update(json.dumps([placeholders.get(arg, arg) for arg in cmd]).encode())
+        excluded = set()
+        for output in outputs:
+            excluded.update(expand_path(output))
+        for path in list(inputs) + list(databases):
+            excluded.update(derived_files(path))
+        for path in list(inputs) + list(databases):
+            hasher.update(path_fingerprint(path, self.full_hash, excluded).encode())
+        return hasher.hexdigest()
+
+    def run(self, cmd, outputs, inputs = (), databases = (), ignored = (), threads = None):
+        """Restores outputs from the cache if an identical run is stored, else runs the command and stores them
+
+        Args:
+            cmd (list): Command to run
+            outputs (list): Output files, directories or MMseqs database prefixes the command writes
+            inputs (list, optional): Input files or directories, hashed by content
+            databases (list, optional): Databases (files, directories or MMseqs prefixes), hashed by content
+            ignored (list, optional): Arguments that don't affect results, such as temp directories
+            threads (int, optional): Threads the command uses, recorded by instrument.run_command
+
+        Returns:
+            Boolean: True if outputs were restored from the cache, False if the command was run
+
+        Raises:
+            JobError: If the command fails, with its return code and stderr. Nothing is stored.
+        """
+        key = self.key(cmd, outputs, inputs, databases, ignored)
+        if self.restore(key, outputs):
+            return True
+        clear_outputs(outputs)
+        record = instrument.run_command(cmd, inputs = list(inputs) + list(databases), threads = threads,
+                                        capture_stderr = True)
+        instrument.check_record(record)
+        self.store(key, cmd, outputs)
+        return False
+
+    def restore(self, key, outputs):
+        """Copies a stored entry's outputs to the given paths
+
+        Returns:
+            Boolean: True if the entry existed and was restored, else False
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(entry, 'manifest.json')):
+            return False
+        self._restore(entry, outputs)
+        return True
+
+    def store(self, key, cmd, outputs):
+        """Stores the outputs of a successful run under a key, if they were all written, then evicts old entries"""
+        if all(expand_path(output) or os.path.isdir(output) for output in outputs):
+            self._store(os.path.join(self.cache_dir, key), cmd, outputs)
+            self.evict()
+
+    def _store(self, entry, cmd, outputs):
+        staging = tempfile.mkdtemp(prefix = '.staging_', dir = self.cache_dir)
+        size = 0
+        stored = []
+        for i, output in enumerate(outputs):
+            target = os.path.join(staging, str(i))
+            if os.path.isdir(output):
+                shutil.copytree(output, target)
+                stored.append({'type': 'dir', 'path': output})
+            else:
+                os.makedirs(target)
+                names = []
+                for filepath in expand_path(output):
+                    shutil.copy2(filepath, target)
+                    names.append(os.path.basename(filepath))
+                stored.append({'type': 'files', 'path': output, 'names': names})
+            size += sum(os.path.getsize(filepath) for filepath in expand_path(target))
+        with open(os.path.join(staging, 'manifest.json'), 'w') as manifest:
+            json.dump({'cmd': cmd, 'outputs': stored, 'size': size, 'created': time.time()}, manifest)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another process stored the same result first
+            shutil.rmtree(staging, ignore_errors = True)
+
+    def _restore(self, entry, outputs):
+        for i, output in enumerate(outputs):
+            source = os.path.join(entry, str(i))
+            if not os.path.isdir(source):
+                continue
+            with open(os.path.join(entry, 'manifest.json'), 'r') as manifest:
+                stored = json.load(manifest)['outputs'][i]
+            if stored['type'] == 'dir':
+                shutil.copytree(source, output, dirs_exist_ok = True)
+            else:
+                output_dir = os.path.dirname(output) or '.'
+                os.makedirs(output_dir, exist_ok = True)
+                stored_prefix = os.path.basename(stored['path'])
+                wanted_prefix = os.path.basename(output)
+                for name in stored['names']:
+                    shutil.copy2(os.path.join(source, name), os.path.join(output_dir, wanted_prefix + name[len(stored_prefix):]))
+        # Manifest mtime records last use for LRU eviction
+        os.utime(os.path.join(entry, 'manifest.json'))
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within max_bytes"""
+        if self.max_bytes is None:
+            return
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.cache_dir, key, 'manifest.json')
+            if key.startswith('.') or not os.path.exists(manifest_path):
+                continue
+            with open(manifest_path, 'r') as manifest:
+                size = json.load(manifest)['size']
+            entries.append((os.path.getmtime(manifest_path), size, key))
+        total = sum(size for last_used, size, key in entries)
+        for last_used, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors = True)
+            total -= size
@@ -0,0 +1,202 @@
+"""asyncio job engine for running external tools concurrently under a CPU and memory budget
+
+Wrappers in run_external build Job objects (e.g. Hmmer.hmmsearch_job) that can be awaited on their
+own or handed to a JobEngine together. Jobs may depend on other jobs, forming a DAG, and a job
+only starts once its dependencies have finished and enough threads and memory are free. Awaited
+jobs all run on one shared default engine, so they share its budget too.
+"""
+import os, asyncio, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from bioutils.run_external import cache as result_cache, instrument
+from bioutils.run_external.instrument import JobError
+
+
+class Job(object):
+    """One external tool invocation, with its resource needs and dependencies"""
+    def __init__(self, cmd, name = None, threads = 1, memory = 0, depends_on = (), outputs = (),
+                 inputs = (), databases = (), ignored = (), cache = None):
+        """Describes a command to run
+
+        Args:
+            cmd (list): Command to run
+            name (str, optional): Name used in errors. Defaults to None, the tool name.
+            threads (int, optional): Threads the command uses, counted against the engine's CPU budget. Defaults to 1.
+            memory (int, optional): Expected peak memory in bytes, counted against the memory budget. Defaults to 0.
+            depends_on (list, optional): Jobs that must finish successfully before this one starts
+            outputs (list, optional): Output paths. Without a cache, the job is skipped if they all exist.
+            inputs (list, optional): Input paths, used for the cache key
+            databases (list, optional): Database paths, used for the cache key
+            ignored (list, optional): Arguments that don't affect results, used for the cache key
+            cache (ResultCache, optional): Cache to reuse results of identical runs. Defaults to None.
+        """
+        self.cmd = [str(arg) for arg in cmd]
+        self.name = name or self.cmd[0]
+        self.threads = threads
+        self.memory = memory
+        self.depends_on = list(depends_on)
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.databases = list(databases)
+        self.ignored = list(ignored)
+        self.cache = cache
+        self.status = 'pending'
+        self.returncode = None
+        self.stderr = None
+        # instrument.RunRecord of the run, unless restored from the cache or skipped
+        self.record = None
+
+    def __repr__(self):
+        return 'Job(' + repr(self.name) + ', status=' + repr(self.status) + ')'
+
+    def __await__(self):
+        """Awaiting a job runs it, and any dependencies, on the shared default engine
+
+        Jobs awaited concurrently (e.g. with asyncio.gather) share its budget and each job runs
+        once, even when several awaited jobs depend on it.
+        """
+        return default_engine().run([self]).__await__()
+
+
+class JobEngine(object):
+    """Runs a DAG of Jobs concurrently without exceeding a thread and memory budget"""
+    def __init__(self, max_threads = None, max_memory = None):
+        """Sets the resource budget shared by all jobs
+
+        Args:
+            max_threads (int, optional): Total threads running jobs may use. Defaults to None, all cores.
+            max_memory (int, optional): Total expected memory in bytes of running jobs. Defaults to None, no limit.
+        """
+        self.max_threads = max_threads or os.cpu_count() or 1
+        self.max_memory = max_memory
+        self.threads_in_use = 0
+        self.memory_in_use = 0
+        # Shared by concurrent run calls on the same event loop, so they wait on one budget
+        self._loop = None
+        self._condition = None
+        self._tasks = {}
+
+    def _loop_state(self):
+        """Returns the condition and job tasks of the running event loop, starting afresh on a new loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self._tasks = {}
+        return self._condition, self._tasks
+
+    def _fits(self, threads, memory):
+        # A job needing more than the whole budget still runs, alone
+        if self.threads_in_use and self.threads_in_use + threads > self.max_threads:
+            return False
+        if self.max_memory is not None and self.memory_in_use and self.memory_in_use + memory > self.max_memory:
+            return False
+        return True
+
+    async def _run_job(self, job, tasks, condition, executor):
+        if job.status == 'done':
+            return job
+        if job.depends_on:
+            await asyncio.gather(*(tasks[dependency] for dependency in job.depends_on), return_exceptions = True)
+            failed = [dependency for dependency in job.depends_on if dependency.status != 'done']
+            if failed:
+                job.status = 'failed'
+                raise JobError(job, job.name + ' not run because dependency ' + failed[0].name + ' failed')
+        loop = asyncio.get_running_loop()
+        key = None
+        if job.cache is not None:
+            key = await loop.run_in_executor(None, job.cache.key, job.cmd, job.outputs, job.inputs, job.databases, job.ignored)
+            if await loop.run_in_executor(None, job.cache.restore, key, job.outputs):
+                job.status = 'done'
+                return job
+            await loop.run_in_executor(None, result_cache.clear_outputs, job.outputs)
+        elif job.outputs and all(os.path.exists(output) for output in job.outputs):
+            job.status = 'done'
+            return job
+        threads = min(job.threads, self.max_threads)
+        async with condition:
+            await condition.wait_for(lambda: self._fits(threads, job.memory))
+            self.threads_in_use += threads
+            self.memory_in_use += job.memory
+        job.status = 'running'
+        try:
+            # Commands run on threads through instrument.run_command, which waits on each child for its rusage
+            job.record = await loop.run_in_executor(executor, instrument.run_command, job.cmd,
+                                                    job.inputs + job.databases, job.threads, job.name,
+                                                    subprocess.DEVNULL, True)
+            job.returncode = job.record.returncode
+            job.stderr = job.record.stderr
+        except BaseException:
+            # e.g. the executable is missing
+            job.status = 'failed'
+            raise
+        finally:
+            async with condition:
+                self.threads_in_use -= threads
+                self.memory_in_use -= job.memory
+                condition.notify_all()
+        if job.returncode != 0:
+            job.status = 'failed'
+            raise JobError(job, job.name + ' exited with return code ' + str(job.returncode) + ': ' + job.stderr.strip()[-2000:])
+        if key is not None:
+            await loop.run_in_executor(None, job.cache.store, key, job.cmd, job.outputs)
+        job.status = 'done'
+        return job
+
+    async def run(self, jobs):
+        """Runs jobs and all of their dependencies, raising the first failure once everything has settled
+
+        Concurrent calls on the same engine share its budget, and a job already scheduled by
+        another call is waited on rather than run again.
+
+        Args:
+            jobs (list): Jobs to run
+
+        Returns:
+            list: The jobs passed in, all with status 'done'
+        """
+        all_jobs = {}
+        stack = list(jobs)
+        while stack:
+            job = stack.pop()
+            if job not in all_jobs:
+                all_jobs[job] = None
+                stack.extend(job.depends_on)
+        condition, scheduled = self._loop_state()
+        tasks = {}
+        # Each running job holds at least one thread of the budget, so this many workers is always enough
+        with ThreadPoolExecutor(self.max_threads) as executor:
+            for job in all_jobs:
+                if job not in scheduled:
+                    scheduled[job] = asyncio.ensure_future(self._run_job(job, tasks, condition, executor))
+                tasks[job] = scheduled[job]
+            results = await asyncio.gather(*tasks.values(), return_exceptions = True)
+        for job, task in tasks.items():
+            if scheduled.get(job) is task:
+                del scheduled[job]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # Prefer a tool's own failure over the dependency failures it caused
+            errors.sort(key = lambda error: getattr(error, 'returncode', None) is None)
+            raise errors[0]
+        return list(jobs)
+
+    def run_sync(self, jobs):
+        """Runs jobs from synchronous code"""
+        return asyncio.run(self.run(jobs))
+
+
+_default_engine = None
+
+
+def default_engine():
+    """Returns the engine awaited jobs run on, created on first use with all cores and no memory limit"""
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = JobEngine()
+    return _default_engine
+
+
+def set_default_engine(engine):
+    """Replaces the engine awaited jobs run on, e.g. with one using a smaller budget"""
+    global _default_engine
+    _default_engine = engine
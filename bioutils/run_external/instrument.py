@@ -0,0 +1,259 @@
+"""Resource accounting for external tool runs
+
+Every command run_external launches goes through run_command, which records wall time, the
+child's own user/system CPU time and peak RSS (from os.wait4), the size of its inputs and its
+exit status in a RunRecord. Records are passed to every registered hook: a JsonLinesSink
+appends them to a run log, and summarize turns a log back into per-tool totals.
+
+Setting the BIOUTILS_RUN_LOG environment variable logs every run to that file.
+
+    python -m bioutils.run_external.instrument run_log.jsonl
+
+prints a summary of a run log.
+"""
+import os, sys, json, time, socket, tempfile, threading, warnings, subprocess
+from bioutils.run_external import cache as result_cache
+
+RUN_LOG_ENV = 'BIOUTILS_RUN_LOG'
+# Characters of stderr kept in the records of failed runs
+STDERR_TAIL = 2000
+_hooks = []
+
+
+class JobError(Exception):
+    """Raised when an external tool exits with a non-zero return code, or a dependency failed"""
+    def __init__(self, job, message):
+        """Built from the failed engine.Job or RunRecord, whose returncode and stderr it keeps"""
+        super().__init__(message)
+        self.job = job
+        self.returncode = job.returncode
+        self.stderr = job.stderr
+
+
+class RunRecord(object):
+    """Resource usage and outcome of one external command"""
+    __slots__ = ('name', 'tool', 'cmd', 'returncode', 'started', 'wall_seconds', 'user_seconds', 'system_seconds',
+                 'max_rss_bytes', 'inputs', 'input_bytes', 'threads', 'host', 'pid', 'stderr')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @property
+    def cpu_seconds(self):
+        return (self.user_seconds or 0.0) + (self.system_seconds or 0.0)
+
+    @property
+    def cpu_efficiency(self):
+        """CPU time over wall time divided by threads: near 1 when every thread stayed busy"""
+        if not self.wall_seconds:
+            return None
+        return self.cpu_seconds / (self.wall_seconds * (self.threads or 1))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return ('RunRecord(' + repr(self.name) + ', returncode=' + str(self.returncode) +
+                ', wall=' + '%.2fs' % self.wall_seconds + ', max_rss=' + str(self.max_rss_bytes) + ')')
+
+
+def add_hook(hook):
+    """Registers a callable that receives the RunRecord of every run, e.g. a JsonLinesSink
+
+    Exceptions raised by hooks are turned into warnings, so a broken sink never fails a run.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Unregisters a hook added with add_hook"""
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def emit(record):
+    """Passes a record to every registered hook"""
+    for hook in list(_hooks):
+        try:
+            hook(record)
+        except Exception as error:
+            warnings.warn('Run hook ' + repr(hook) + ' failed: ' + repr(error))
+
+
+class JsonLinesSink(object):
+    """Hook appending each record as one line of JSON to a run log"""
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record.as_dict()) + '\n'
+        with self.lock:
+            # One write per record in append mode, so processes sharing a log don't interleave lines
+            with open(self.log_path, 'a') as outf:
+                outf.write(line)
+
+    def __repr__(self):
+        return 'JsonLinesSink(' + repr(self.log_path) + ')'
+
+
+class RecordCollector(object):
+    """Hook keeping records in memory, for summarizing runs within one session"""
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+def log_runs_to(log_path):
+    """Logs every subsequent run to a JSON lines file
+
+    Returns:
+        JsonLinesSink: The registered hook, which can be passed to remove_hook
+    """
+    return add_hook(JsonLinesSink(log_path))
+
+
+def _input_bytes(inputs):
+    total = 0
+    for path in inputs:
+        for filepath in result_cache.expand_path(path):
+            total += os.path.getsize(filepath)
+    return total
+
+
+def run_command(cmd, inputs = (), threads = None, name = None, stdout = None, capture_stderr = False):
+    """Runs a command, recording its resource usage, and passes the record to the registered hooks
+
+    On Linux a child's peak RSS includes memory it shared with this Python process before exec,
+    so small tools report roughly the parent's RSS as a floor.
+
+    Args:
+        cmd (list): Command to run
+        inputs (list, optional): Input files, directories or MMseqs databases, whose total size is recorded
+        threads (int, optional): Threads the command was asked to use, recorded for efficiency. Defaults to None.
+        name (str, optional): Name for the record. Defaults to None, the tool name.
+        stdout (optional): Where stdout goes, as for subprocess.Popen. Defaults to None, inherited.
+        capture_stderr (bool, optional): Capture stderr into the record instead of passing it
+            through. Defaults to False.
+
+    Returns:
+        RunRecord: The finished run's record, with the full stderr if captured
+    """
+    cmd = [str(arg) for arg in cmd]
+    try:
+        input_bytes = _input_bytes(inputs)
+    except OSError:
+        input_bytes = None
+    stderr_file = tempfile.TemporaryFile() if capture_stderr else None
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(cmd, stdout = stdout, stderr = stderr_file)
+        if hasattr(os, 'wait4'):
+            # wait4 gives this child's own rusage, unlike RUSAGE_CHILDREN which sums every child so far
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in KiB on Linux and bytes on macOS
+            max_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+            user_seconds, system_seconds = usage.ru_utime, usage.ru_stime
+        else:
+            process.wait()
+            max_rss = user_seconds = system_seconds = None
+        wall_seconds = time.perf_counter() - start
+        stderr = None
+        if stderr_file is not None:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors = 'replace')
+    finally:
+        if stderr_file is not None:
+            stderr_file.close()
+    record = RunRecord(name = name or os.path.basename(cmd[0]), tool = os.path.basename(cmd[0]), cmd = cmd,
+                       returncode = process.returncode, started = started, wall_seconds = wall_seconds,
+                       user_seconds = user_seconds, system_seconds = system_seconds, max_rss_bytes = max_rss,
+                       inputs = [str(path) for path in inputs], input_bytes = input_bytes, threads = threads,
+                       host = socket.gethostname(), pid = process.pid, stderr = stderr)
+    logged = RunRecord(**record.as_dict())
+    # Only failures keep stderr in the log, and only its tail
+    logged.stderr = stderr[-STDERR_TAIL:] if record.returncode != 0 and stderr is not None else None
+    emit(logged)
+    return record
+
+
+def check_record(record):
+    """Raises JobError with the return code and stderr tail of a failed run, else returns the record"""
+    if record.returncode != 0:
+        raise JobError(record, record.name + ' exited with return code ' + str(record.returncode) + ': ' +
+                       (record.stderr or '').strip()[-STDERR_TAIL:])
+    return record
+
+
+def read_run_log(log_path):
+    """Reads the RunRecords of a JSON lines run log"""
+    with open(log_path, 'r') as inf:
+        return [RunRecord(**json.loads(line)) for line in inf if line.strip()]
+
+
+def summarize(records):
+    """Totals resource use per tool
+
+    Args:
+        records (list or str): RunRecords, or the path to a run log
+
+    Returns:
+        dict: tool: dict of runs, failures, wall/CPU seconds (total, mean, max), peak RSS,
+        input bytes, mean CPU efficiency and the slowest run's inputs
+    """
+    if isinstance(records, str):
+        records = read_run_log(records)
+    summary = {}
+    for record in records:
+        tool = summary.setdefault(record.tool, {
+            'runs': 0, 'failures': 0, 'wall_seconds': 0.0, 'max_wall_seconds': 0.0, 'cpu_seconds': 0.0,
+            'max_rss_bytes': 0, 'input_bytes': 0, 'efficiencies': [], 'slowest_inputs': None,
+        })
+        tool['runs'] += 1
+        tool['failures'] += record.returncode != 0
+        tool['wall_seconds'] += record.wall_seconds
+        tool['cpu_seconds'] += record.cpu_seconds
+        tool['max_rss_bytes'] = max(tool['max_rss_bytes'], record.max_rss_bytes or 0)
+        tool['input_bytes'] += record.input_bytes or 0
+        if record.cpu_efficiency is not None:
+            tool['efficiencies'].append(record.cpu_efficiency)
+        if record.wall_seconds >= tool['max_wall_seconds']:
+            tool['max_wall_seconds'] = record.wall_seconds
+            tool['slowest_inputs'] = record.inputs
+    for tool in summary.values():
+        tool['mean_wall_seconds'] = tool['wall_seconds'] / tool['runs']
+        efficiencies = tool.pop('efficiencies')
+        tool['mean_cpu_efficiency'] = sum(efficiencies) / len(efficiencies) if efficiencies else None
+    return summary
+
+
+def format_summary(summary):
+    """Formats the output of summarize as a text table"""
+    lines = ['%-16s %6s %6s %12s %10s %10s %12s %12s %6s' % ('tool', 'runs', 'failed', 'wall_total_s', 'wall_mean',
+                                                            'wall_max', 'cpu_total_s', 'peak_rss_mib', 'eff')]
+    for tool, values in sorted(summary.items(), key = lambda item: -item[1]['wall_seconds']):
+        efficiency = values['mean_cpu_efficiency']
+        lines.append('%-16s %6d %6d %12.1f %10.1f %10.1f %12.1f %12.1f %6s' % (
+            tool, values['runs'], values['failures'], values['wall_seconds'], values['mean_wall_seconds'],
+            values['max_wall_seconds'], values['cpu_seconds'], values['max_rss_bytes'] / 2 ** 20,
+            '-' if efficiency is None else '%.2f' % efficiency))
+    return '\n'.join(lines)
+
+
+if os.environ.get(RUN_LOG_ENV):
+    log_runs_to(os.environ[RUN_LOG_ENV])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Summarize a bioutils run log')
+    parser.add_argument('run_log')
+    args = parser.parse_args()
+    print(format_summary(summarize(args.run_log)))
@@ -1,5 +1,45 @@
-from distutils.spawn import find_executable
-import os
+import os, shutil, functools, subprocess
+
+# Arguments used to get version information from each tool
+VERSION_ARGS = {
+    'hmmsearch': ['-h'],
+    'prodigal': ['-v'],
+    'mmseqs': ['version'],
+    'checkm': ['-h'],
+}
+
+
+@functools.lru_cache(maxsize = None)
+def resolve_tool(tool, user_path = None):
+    """Finds a tool's executable, searching PATH once per process for each tool and path
+
+    Args:
+        tool (str): Name of tool executable (e.g., mmseqs, hmmsearch)
+        user_path (str, optional): User-specified environment path. Defaults to None, which is the global Path.
+
+    Returns:
+        str: Path to the executable, or None if it can't be found
+    """
+    return shutil.which(tool, path = user_path)
+
+
+@functools.lru_cache(maxsize = None)
+def tool_version(tool):
+    """Returns a tool's version output, probing it once per process
+
+    Args:
+        tool (str): Name of tool executable
+
+    Returns:
+        bytes: Combined stdout and stderr of the version command, empty if the tool can't be run
+    """
+    args = VERSION_ARGS.get(tool, ['--version'])
+    try:
+        result = subprocess.run([tool] + args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    except OSError:
+        return b''
+    return result.stdout
+
 
 def path_check(tool, user_path = None):
     """Checks if tool is on path
@@ -11,12 +51,10 @@ def path_check(tool, user_path = None):
     Returns:
         Boolean : True if tool on path, else False
     """
-    if user_path is None:
-        user_path = os.environ['PATH']
-    if find_executable(tool, path = user_path) is not None:
+    if resolve_tool(tool, user_path) is not None:
         return True
     else:
-        print(tool + ' cannot be found on ' + user_path)
+        print(tool + ' cannot be found on ' + (user_path if user_path is not None else os.environ.get('PATH', '')))
         return False
 
 def multiple_path_check(tools, user_path = None):
@@ -29,9 +67,7 @@ def multiple_path_check(tools, user_path = None):
     Returns:
         Boolean : True if every tool is on path, else False. Will print tools it can't find to console
     """
-    if user_path is None:
-        user_path = os.environ['PATH']
     for tool in tools:
-        if not path_check(tool, path = user_path):
+        if not path_check(tool, user_path = user_path):
             return False
-    return True
\ No newline at end of file
+    return True
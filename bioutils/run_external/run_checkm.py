@@ -1,10 +1,26 @@
-import os, subprocess
-from bioutils.run_external import path_check
+import os
+from bioutils.run_external import instrument
+from bioutils.run_external.path_check import path_check
+from bioutils.run_external.engine import Job
 from bioutils import utilities
+from bioutils.tables import LazyRecord, LazyField, iter_delimited_chunks
+
+# Column name and dtype for each field of the CheckM --tab-table output, in file order
+CHECKM_COLUMNS = [
+    ('bin_id', object), ('marker_lineage', object), ('num_genomes', 'int64'), ('num_markers', 'int64'),
+    ('num_marker_sets', 'int64'), ('id_0', 'int64'), ('id_1', 'int64'), ('id_2', 'int64'), ('id_3', 'int64'),
+    ('id_4', 'int64'), ('id_5plus', 'int64'), ('completeness', 'float64'), ('contamination', 'float64'),
+    ('strain_heterogenity', 'float64'), ('genome_size', 'int64'), ('num_ambiguous_bases', 'int64'),
+    ('num_scaffolds', 'int64'), ('num_contigs', 'int64'), ('n50_scaffolds', 'int64'), ('n50_contigs', 'int64'),
+    ('longest_scaffold', 'int64'), ('longest_contig', 'int64'), ('gc', 'float64'), ('coding_density', 'float64'),
+    ('translation_table', object), ('num_predicted_genes', 'int64'),
+]
+# CheckM tables start with a header row
+CHECKM_HEADER_PREFIX = 'Bin Id'
 
 class CheckM(object):
     """Runs CheckM on a set of genomes"""
-    def __init__(self, user_path, method = "lineage_wf", domain = None, genome_type = 'fna', threads = 1):
+    def __init__(self, user_path, method = "lineage_wf", domain = None, genome_type = 'fna', threads = 1, cache = None):
         """Initializes with a path to directory containing genomes in nucleotide or amino acid FASTA format
 
         Args:
@@ -12,8 +28,11 @@ class CheckM(object):
             method (str): Which CheckM workflow to use (lineage_wf or taxonomy_wf)
             domain (str): If taxonomy_wf is chosen, specifies which taxonomic domain to use (e.g., Bacteria)
             threads (int): Number of threads to use for CheckM
+            cache (ResultCache, optional): Cache to reuse results of identical runs. Defaults to None,
+                which skips runs whose output table exists.
         """
         self.user_path = user_path
+        self.cache = cache
         if method == 'lineage_wf':
             self.method = 'lineage_wf'
         elif method == 'taxonomy_wf':
@@ -28,48 +47,76 @@ class CheckM(object):
         self.threads = str(threads)
         path_check('checkm', self.user_path)
             
-    def run_checkm_workflow(self, genome_dir, output_dir, output_tsv):
-        utilities.create_directory(output_dir)
+    def _checkm_cmd(self, genome_dir, output_dir, output_tsv):
         if self.method == 'lineage_wf':
             checkm_cmd = ['checkm', self.method, genome_dir, output_dir, '-f', output_tsv, '--tab-table', '-x', self.genome_type, '-t', self.threads]
         elif self.method == 'taxonomy_wf':
-            checkm_cmd = ['checkm', self.method, 'domain', self.domain, genome_dir, output_dir, '-f', output_tsv, '--tab-table', '-x', self.genome_type, '-t', threads]
+            checkm_cmd = ['checkm', self.method, 'domain', self.domain, genome_dir, output_dir, '-f', output_tsv, '--tab-table', '-x', self.genome_type, '-t', self.threads]
         if self.genome_type == 'faa':
             checkm_cmd.append('-g')
-        if not os.path.exists(output_tsv):
-            subprocess.run(checkm_cmd)
+        return checkm_cmd
+
+    def run_checkm_workflow(self, genome_dir, output_dir, output_tsv):
+        """Runs the CheckM workflow, raising JobError with its return code and stderr if it fails"""
+        utilities.create_directory(output_dir)
+        checkm_cmd = self._checkm_cmd(genome_dir, output_dir, output_tsv)
+        if self.cache is not None:
+            self.cache.run(checkm_cmd, [output_dir, output_tsv], inputs = [genome_dir], threads = int(self.threads))
+        elif not os.path.exists(output_tsv):
+            instrument.check_record(instrument.run_command(checkm_cmd, inputs = [genome_dir], threads = int(self.threads),
+                                                           capture_stderr = True))
+
+    def checkm_job(self, genome_dir, output_dir, output_tsv, memory = 40 * 1024 ** 3, depends_on = ()):
+        """Builds a Job running the same workflow as run_checkm_workflow, for use with engine.JobEngine
+
+        Args:
+            genome_dir (str): Directory of genomes
+            output_dir (str): CheckM output directory
+            output_tsv (str): Path for the tabular summary
+            memory (int, optional): Expected peak memory in bytes. Defaults to 40 GiB, CheckM's pplacer step.
+            depends_on (list, optional): Jobs that must finish first
+
+        Returns:
+            Job: Awaitable job
+        """
+        checkm_cmd = self._checkm_cmd(genome_dir, output_dir, output_tsv)
+        return Job(checkm_cmd, name = 'checkm ' + self.method, threads = int(self.threads), memory = memory,
+                   depends_on = depends_on, outputs = [output_dir, output_tsv], inputs = [genome_dir], cache = self.cache)
             
 
-class CheckMHit(object):
+class CheckMHit(LazyRecord):
     """Stores one line of the CheckM tabular output file"""
+    __slots__ = ()
+    bin_id = LazyField(0)
+    marker_lineage = LazyField(1)
+    num_genomes = LazyField(2, int)
+    num_markers = LazyField(3, int)
+    num_marker_sets = LazyField(4, int)
+    id_0 = LazyField(5, int)
+    id_1 = LazyField(6, int)
+    id_2 = LazyField(7, int)
+    id_3 = LazyField(8, int)
+    id_4 = LazyField(9, int)
+    id_5plus = LazyField(10, int)
+    completeness = LazyField(11, float)
+    contamination = LazyField(12, float)
+    strain_heterogenity = LazyField(13, float)
+    genome_size = LazyField(14, int)
+    num_ambiguous_bases = LazyField(15, int)
+    num_scaffolds = LazyField(16, int)
+    num_contigs = LazyField(17, int)
+    n50_scaffolds = LazyField(18, int)
+    n50_contigs = LazyField(19, int)
+    longest_scaffold = LazyField(20, int)
+    longest_contig = LazyField(21, int)
+    gc = LazyField(22, float)
+    coding_density = LazyField(23, float)
+    translation_table = LazyField(24)
+    num_predicted_genes = LazyField(25, int)
+
     def __init__(self, checkm_tsv_line):
-        """"Expects a list of 26 elements"""
-        self.bin_id = str(checkm_tsv_line[0])
-        self.marker_lineage = str(checkm_tsv_line[1])
-        self.num_genomes = int(checkm_tsv_line[2])
-        self.num_markers = int(checkm_tsv_line[3])
-        self.num_marker_sets = int(checkm_tsv_line[4])
-        self.id_0 = int(checkm_tsv_line[5])
-        self.id_1 = int(checkm_tsv_line[6])
-        self.id_2 = int(checkm_tsv_line[7])
-        self.id_3 = int(checkm_tsv_line[8])
-        self.id_4 = int(checkm_tsv_line[9])
-        self.id_5plus = int(checkm_tsv_line[10])
-        self.completeness = float(checkm_tsv_line[11])
-        self.contamination = float(checkm_tsv_line[12])
-        self.strain_heterogenity = float(checkm_tsv_line[13])
-        self.genome_size = int(checkm_tsv_line[14])
-        self.num_ambiguous_bases = int(checkm_tsv_line[15])
-        self.num_scaffolds = int(checkm_tsv_line[16])
-        self.num_contigs = int(checkm_tsv_line[17])
-        self.n50_scaffolds = int(checkm_tsv_line[18])
-        self.n50_contigs = int(checkm_tsv_line[19])
-        self.longest_scaffold = int(checkm_tsv_line[20])
-        self.longest_contig = int(checkm_tsv_line[21])
-        self.gc = float(checkm_tsv_line[22])
-        self.coding_density = float(checkm_tsv_line[23])
-        self.translation_table = str(checkm_tsv_line[24])
-        self.num_predicted_genes = int(checkm_tsv_line[25])
+        """Expects a tab-separated line, or a list of its 26 elements"""
+        super().__init__(checkm_tsv_line)
         
 
 class CheckMParser(object):
@@ -81,7 +128,21 @@ class CheckMParser(object):
         hits = []
         with open(self.input_file, 'r') as checkmfile:
             for line in checkmfile:
-                line = line.rstrip().split('\t')
+                if line.startswith(CHECKM_HEADER_PREFIX):
+                    continue
                 line_parsed = CheckMHit(line)
                 hits.append(line_parsed)
-        return hits
\ No newline at end of file
+        return hits
+
+    def iter_chunks(self, chunk_size = 100000, usecols = None):
+        """Reads the table in fixed-size chunks of typed columns
+
+        Args:
+            chunk_size (int, optional): Lines per chunk. Defaults to 100000.
+            usecols (list, optional): Columns to keep (e.g. ['bin_id', 'completeness']). Defaults to None, all.
+
+        Yields:
+            ColumnarTable: Rows of each chunk
+        """
+        return iter_delimited_chunks(self.input_file, CHECKM_COLUMNS, chunk_size, usecols,
+                                     header_prefix = CHECKM_HEADER_PREFIX)
@@ -1,62 +1,408 @@
 # Named this run_hmmer even though it's only hmmsearch for potential future uses of hmmpress and hmmbuild
 # Biopython has an HMM parser, but it's relatively clunky
 
-import os, subprocess
-from bioutils.run_external import path_check
+import os, itertools, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from bioutils import utilities, fasta_ops
+from bioutils.run_external import instrument
+from bioutils.run_external.path_check import path_check
+from bioutils.run_external.engine import Job
+from bioutils.tables import ColumnarTable, LazyRecord, LazyField, split_whitespace_fields, parse_numeric_fields, encode_string_fields
+
+# Column name and dtype for each field of a domtblout line, in file order
+DOMTBLOUT_COLUMNS = [
+    ('target_name', object), ('target_acc', object), ('target_len', 'int64'),
+    ('query_name', object), ('query_acc', object), ('query_len', 'int64'),
+    ('e_value', 'float64'), ('bitscore', 'float64'), ('bias', 'float64'),
+    ('domain_number', 'int64'), ('total_domains', 'int64'),
+    ('conditional_evalue', 'float64'), ('independent_evalue', 'float64'),
+    ('domain_bitscore', 'float64'), ('domain_bias', 'float64'),
+    ('hmm_from', 'int64'), ('hmm_to', 'int64'), ('ali_from', 'int64'), ('ali_to', 'int64'),
+    ('env_from', 'int64'), ('env_to', 'int64'), ('posterior_probability', 'float64'),
+    ('description', object),
+]
 
 class Hmmer(object):
     """Runs HMMsearch for now, but is generalizable for other HMMER subprograms
     """
-    def __init__(self, user_path = None):
+    def __init__(self, user_path = None, cache = None):
+        """Class for running HMMER programs
+
+        Args:
+            user_path (str, optional): Path for calling HMMER. Defaults to None, which is the base Path.
+            cache (ResultCache, optional): Cache to reuse results of identical runs. Defaults to None,
+                which skips runs whose output file exists.
+        """
         self.user_path = user_path
+        self.cache = cache
         path_check('hmmsearch', self.user_path)
         
-    def run_hmmsearch(self, output_path, input_file, hmm_db):
+    def run_hmmsearch(self, output_path, input_file, hmm_db, cpus = None):
         """Runs an HMMsearch on an input FASTA given an HMM database, returning a domain table tabular format
 
         Args:
             output_path (str): Path to deposit domtblout file
             input_file (str): Path to input FASTA (should be protein format)
             hmm_db (str): Path to HMM database
+            cpus (int, optional): Number of worker threads for hmmsearch (--cpu). Defaults to None, HMMER's default.
+
+        Raises:
+            JobError: If hmmsearch fails, with its return code and stderr
         """
+        hmmsearch_cmd = self._hmmsearch_cmd(output_path, input_file, hmm_db, cpus)
+        if self.cache is not None:
+            self.cache.run(hmmsearch_cmd, [output_path], inputs = [input_file], databases = [hmm_db], threads = cpus)
+        elif not os.path.exists(output_path):
+            instrument.check_record(instrument.run_command(hmmsearch_cmd, inputs = [input_file, hmm_db], threads = cpus,
+                                                           capture_stderr = True))
+
+    def _hmmsearch_cmd(self, output_path, input_file, hmm_db, cpus = None):
         hmmsearch_cmd = ['hmmsearch', '--domtblout', output_path, hmm_db, input_file]
-        if not os.path.exists(output_path):
-            subprocess.run(hmmsearch_cmd)
+        if cpus is not None:
+            hmmsearch_cmd[1:1] = ['--cpu', str(cpus)]
+        return hmmsearch_cmd
+
+    def hmmsearch_job(self, output_path, input_file, hmm_db, cpus = None, depends_on = ()):
+        """Builds a Job running the same search as run_hmmsearch, for use with engine.JobEngine
+
+        Args:
+            output_path (str): Path to deposit domtblout file
+            input_file (str): Path to input FASTA (should be protein format)
+            hmm_db (str): Path to HMM database
+            cpus (int, optional): Number of worker threads for hmmsearch (--cpu). Defaults to None, HMMER's default of 2.
+            depends_on (list, optional): Jobs that must finish first, e.g. the Prodigal job making input_file
+
+        Returns:
+            Job: Awaitable job
+        """
+        hmmsearch_cmd = self._hmmsearch_cmd(output_path, input_file, hmm_db, cpus)
+        return Job(hmmsearch_cmd, name = 'hmmsearch ' + os.path.basename(input_file), threads = cpus or 2,
+                   depends_on = depends_on, outputs = [output_path], inputs = [input_file],
+                   databases = [hmm_db], cache = self.cache)
+
+    def run_hmmsearch_sharded(self, output_path, input_file, hmm_db, shards = None, cpus_per_worker = 2,
+                              z_value = None, dom_z = None, tmp_dir = None):
+        """Runs HMMsearch over balanced shards of the input FASTA in parallel, merging into one domtblout
+
+        hmmsearch scales poorly past a few threads, so several smaller searches are run side by side.
+        -Z is set to the number of input sequences (unless given), so sequence E-values match an
+        unsharded run. Domain i-Evalues and domain reporting depend on --domZ, which hmmsearch
+        otherwise sets per query from the number of reported targets, and a shard only sees some
+        of them. Without dom_z, the shards therefore only write per-sequence tables, from which
+        each query's domZ is counted, and the reported targets are searched again with that --domZ,
+        in one run per distinct domZ. The result then matches an unsharded run.
+
+        Args:
+            output_path (str): Path to deposit merged domtblout file
+            input_file (str): Path to input FASTA (should be protein format)
+            hmm_db (str): Path to HMM database. Without dom_z it must be a text HMM file.
+            shards (int, optional): Number of shards. Defaults to None, which is cores // cpus_per_worker.
+            cpus_per_worker (int, optional): Threads given to each hmmsearch (--cpu). Defaults to 2.
+            z_value (int, optional): Search space size (-Z). Defaults to None, the number of input sequences.
+            dom_z (int, optional): Domain search space size (--domZ). Defaults to None, HMMER's default.
+            tmp_dir (str, optional): Directory for shard files. Defaults to None, the system temp directory.
+
+        Raises:
+            JobError: If any shard's hmmsearch fails, with its return code and stderr. Nothing is merged then.
+        """
+        if shards is None:
+            shards = max(1, (os.cpu_count() or 1) // cpus_per_worker)
+        # The command an unsharded run would use, recorded in the merged footer and keying the cache
+        unsharded_cmd = ['hmmsearch', '--domtblout', output_path]
+        if z_value is not None:
+            unsharded_cmd += ['-Z', str(z_value)]
+        if dom_z is not None:
+            unsharded_cmd += ['--domZ', str(dom_z)]
+        unsharded_cmd += [hmm_db, input_file]
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(unsharded_cmd, [output_path], inputs = [input_file], databases = [hmm_db])
+            if self.cache.restore(key, [output_path]):
+                return
+        elif os.path.exists(output_path):
+            return
+        shard_dir = tempfile.mkdtemp(prefix = 'hmmsearch_shards_', dir = tmp_dir)
+        try:
+            shard_fastas, num_sequences = split_fasta_by_residues(input_file, shard_dir, shards)
+            if z_value is None:
+                z_value = num_sequences
+            base_cmd = ['hmmsearch', '--cpu', str(cpus_per_worker), '-Z', str(z_value), '-o', os.devnull]
+            outputs = [shard_fasta + '.domtblout' for shard_fasta in shard_fastas]
+            replacements = {shard_fastas[0]: input_file, outputs[0]: output_path}
+            if dom_z is not None:
+                _run_searches([base_cmd + ['--domZ', str(dom_z), '--domtblout', shard_output, hmm_db, shard_fasta]
+                               for shard_fasta, shard_output in zip(shard_fastas, outputs)],
+                              [[shard_fasta, hmm_db] for shard_fasta in shard_fastas], cpus_per_worker, 'hmmsearch shard')
+            else:
+                tblouts = [shard_fasta + '.tblout' for shard_fasta in shard_fastas]
+                _run_searches([base_cmd + ['--tblout', tblout, '--domtblout', shard_output, hmm_db, shard_fasta]
+                               for shard_fasta, tblout, shard_output in zip(shard_fastas, tblouts, outputs)],
+                              [[shard_fasta, hmm_db] for shard_fasta in shard_fastas], cpus_per_worker, 'hmmsearch shard')
+                reported = read_tblout_targets(tblouts)
+                groups = {}
+                for query, targets in reported.items():
+                    groups.setdefault(len(targets), []).append(query)
+                # Without any reported target the shard domtblouts are already complete (and empty)
+                if groups:
+                    group_hmms = []
+                    group_fastas = []
+                    group_targets = []
+                    for i, (group_dom_z, queries) in enumerate(sorted(groups.items())):
+                        group_hmm = os.path.join(shard_dir, 'domz_' + str(i) + '.hmm')
+                        write_hmm_subset(hmm_db, queries, group_hmm)
+                        group_hmms.append(group_hmm)
+                        group_fastas.append(os.path.join(shard_dir, 'domz_' + str(i) + '.faa'))
+                        group_targets.append(set().union(*(reported[query] for query in queries)))
+                    _write_target_subsets(input_file, group_fastas, group_targets)
+                    outputs = [group_fasta + '.domtblout' for group_fasta in group_fastas]
+                    _run_searches([base_cmd + ['--domZ', str(group_dom_z), '--domtblout', group_output, group_hmm, group_fasta]
+                                   for group_dom_z, group_hmm, group_fasta, group_output
+                                   in zip(sorted(groups), group_hmms, group_fastas, outputs)],
+                                  [[group_fasta, group_hmm] for group_fasta, group_hmm in zip(group_fastas, group_hmms)],
+                                  cpus_per_worker, 'hmmsearch domZ group', workers = shards)
+                    replacements = {group_fastas[0]: input_file, group_hmms[0]: hmm_db, outputs[0]: output_path}
+            merge_domtblouts(outputs, output_path, hmm_db, replacements = replacements, command = unsharded_cmd)
+            if key is not None:
+                self.cache.store(key, unsharded_cmd, [output_path])
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors = True)
+
+
+def _run_searches(commands, inputs, cpus_per_worker, name, workers = None):
+    """Runs hmmsearch commands side by side, raising JobError for the first that failed"""
+    with ThreadPoolExecutor(workers or len(commands)) as executor:
+        futures = [executor.submit(instrument.run_command, cmd, cmd_inputs, cpus_per_worker, name + ' ' + str(i),
+                                   capture_stderr = True)
+                   for i, (cmd, cmd_inputs) in enumerate(zip(commands, inputs))]
+        records = [future.result() for future in futures]
+    for record in records:
+        instrument.check_record(record)
+
+
+def _iter_fasta_records(input_fasta):
+    """Yields (sequence name, residue count, record bytes) with the header line kept whole, so
+    descriptions reach hmmsearch as they are in the input"""
+    name = None
+    record = []
+    residues = 0
+    with utilities.open_compressed(input_fasta) as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, residues, b''.join(record)
+                fields = line[1:].split(None, 1)
+                name = fields[0].decode() if fields else ''
+                record = [line if line.endswith(b'\n') else line + b'\n']
+                residues = 0
+            elif name is not None:
+                record.append(line if line.endswith(b'\n') else line + b'\n')
+                residues += len(line.strip())
+    if name is not None:
+        yield name, residues, b''.join(record)
+
+
+def split_fasta_by_residues(input_fasta, output_dir, shards):
+    """Splits a FASTA into shards with roughly equal residue counts, in one streaming pass
+
+    Each record goes to the shard with the fewest residues so far, so shard sizes differ by at
+    most the longest sequence. Records are copied unchanged, descriptions included.
+
+    Args:
+        input_fasta (str): Path to input FASTA
+        output_dir (str): Directory to write shards to
+        shards (int): Number of shards
+
+    Returns:
+        tuple: (list of shard FASTA paths, number of sequences)
+    """
+    shard_fastas = [os.path.join(output_dir, 'shard_' + str(i) + '.faa') for i in range(shards)]
+    handles = [open(shard_fasta, 'wb') for shard_fasta in shard_fastas]
+    residues = [0] * shards
+    num_sequences = 0
+    try:
+        for name, length, record in _iter_fasta_records(input_fasta):
+            shard = residues.index(min(residues))
+            handles[shard].write(record)
+            residues[shard] += max(length, 1)
+            num_sequences += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    used = [shard_fasta for shard_fasta, count in zip(shard_fastas, residues) if count > 0]
+    return used or shard_fastas[:1], num_sequences
+
+
+def _write_target_subsets(input_fasta, output_fastas, target_sets):
+    """Writes each set of target sequences from input_fasta to its own FASTA, in one streaming pass"""
+    handles = [open(output_fasta, 'wb') for output_fasta in output_fastas]
+    try:
+        for name, length, record in _iter_fasta_records(input_fasta):
+            for handle, targets in zip(handles, target_sets):
+                if name in targets:
+                    handle.write(record)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def read_tblout_targets(tblouts):
+    """Reads the targets each query reported in hmmsearch --tblout files
+
+    Returns:
+        dict: query name: set of target names
+    """
+    reported = {}
+    for tblout in tblouts:
+        with open(tblout, 'r') as tbl:
+            for line in tbl:
+                if line.startswith('#'):
+                    continue
+                fields = line.split(None, 3)
+                if len(fields) >= 3:
+                    reported.setdefault(fields[2], set()).add(fields[0])
+    return reported
+
+
+def write_hmm_subset(hmm_db, names, output_path):
+    """Copies the named HMMs of a text HMM file to a new file, in database order"""
+    names = set(names)
+    found = set()
+    with open(hmm_db, 'r') as hmmfile, open(output_path, 'w') as outf:
+        record = []
+        for line in hmmfile:
+            record.append(line)
+            if line.startswith('//'):
+                name = next((line.split()[1] for line in record if line.startswith('NAME ')), None)
+                if name in names:
+                    outf.writelines(record)
+                    found.add(name)
+                record = []
+    if found != names:
+        raise ValueError('HMMs not found in ' + hmm_db + ', which must be a text HMM file: ' +
+                         ', '.join(sorted(names - found)[:10]))
+
+
+def read_hmm_names(hmm_db):
+    """Returns HMM names in database order, read from the NAME lines of a text HMM file"""
+    names = []
+    with open(hmm_db, 'r') as hmmfile:
+        for line in hmmfile:
+            if line.startswith('NAME '):
+                names.append(line.split()[1])
+    return names
+
+
+def merge_domtblouts(domtblouts, output_path, hmm_db = None, replacements = None, command = None):
+    """Merges domtblouts from sharded searches into one, ordered as a single search would be
+
+    Rows are grouped by query HMM in database order, then sorted by descending full-sequence
+    score with each target's domains kept together. Targets whose printed scores tie may come out
+    in a different order than hmmsearch, which sorts on unrounded scores. Comment lines are taken
+    from the first shard.
+
+    Args:
+        domtblouts (list): Paths to shard domtblout files
+        output_path (str): Path to write merged domtblout
+        hmm_db (str, optional): HMM database, used to order queries. Defaults to None, which
+            orders queries by first appearance.
+        replacements (dict, optional): Substrings to replace in comment lines (e.g. shard paths).
+            Longer substrings are replaced first, so a path is never caught by its own prefix.
+        command (list, optional): Command written on the '# Option settings' line instead of the
+            first shard's, e.g. the equivalent unsharded search. Defaults to None.
+    """
+    header_lines = []
+    footer_lines = []
+    rows_by_query = {}
+    for shard_idx, domtblout in enumerate(domtblouts):
+        seen_rows = False
+        with open(domtblout, 'r') as domtbl:
+            for line in domtbl:
+                if line.startswith('#'):
+                    if shard_idx == 0:
+                        (footer_lines if seen_rows else header_lines).append(line)
+                    continue
+                fields = line.split(None, 10)
+                if len(fields) < 10:
+                    continue
+                seen_rows = True
+                key = (-float(fields[7]), shard_idx, fields[0], int(fields[9]))
+                rows_by_query.setdefault(fields[3], []).append((key, line))
+    # An empty first shard has no rows, so everything after the column header is footer
+    if not footer_lines and len(header_lines) > 2:
+        header_lines, footer_lines = header_lines[:2], header_lines[2:]
+    query_order = read_hmm_names(hmm_db) if hmm_db is not None and os.path.isfile(hmm_db) else []
+    query_rank = {name: rank for rank, name in enumerate(query_order)}
+    queries = sorted(rows_by_query, key = lambda query: query_rank.get(query, len(query_rank)))
+    tmp_output = output_path + '.tmp'
+    with open(tmp_output, 'w') as outf:
+        outf.writelines(header_lines)
+        for query in queries:
+            outf.writelines(line for key, line in sorted(rows_by_query[query], key = lambda row: row[0]))
+        ordered_replacements = sorted((replacements or {}).items(), key = lambda item: -len(item[0]))
+        for line in footer_lines:
+            if command is not None and line.startswith('# Option settings:'):
+                settings = line[len('# Option settings:'):]
+                line = '# Option settings:' + settings[:len(settings) - len(settings.lstrip())] + ' '.join(command) + ' \n'
+            else:
+                for old, new in ordered_replacements:
+                    line = line.replace(old, new)
+            outf.write(line)
+    os.replace(tmp_output, output_path)
             
 
-class HmmHit(object):
-    """Stores a single line of an HMMsearch domtblout with every element as its own value"""
+class HmmHit(LazyRecord):
+    """Stores a single line of an HMMsearch domtblout, decoding each element as its own value when accessed"""
+    __slots__ = ()
+    delimiter = None
+    maxsplit = 22
+
+    target_name = LazyField(0)
+    target_len = LazyField(2, int)
+    query_name = LazyField(3)
+    query_len = LazyField(5, int)
+    e_value = LazyField(6, float)
+    bitscore = LazyField(7, float)
+    bias = LazyField(8, float)
+    domain_number = LazyField(9, int)
+    total_domains = LazyField(10, int)
+    conditional_evalue = LazyField(11, float)
+    independent_evalue = LazyField(12, float)
+    domain_bitscore = LazyField(13, float)
+    domain_bias = LazyField(14, float)
+    hmm_from = LazyField(15, int)
+    hmm_to = LazyField(16, int)
+    ali_from = LazyField(17, int)
+    ali_to = LazyField(18, int)
+    env_from = LazyField(19, int)
+    env_to = LazyField(20, int)
+    posterior_probability = LazyField(21, float)
+    description = LazyField(22, default = '')
+
     def __init__(self, domtblout_line):
-        """Expects a list of 23 elements"""
-        self.target_name = str(domtblout_line[0])
-        self.target_acc = str(domtblout_line[1])
-        if self.target_acc == '-':
-            self.target_acc = self.target_name # This happens often
-        self.target_len = int(domtblout_line[2])
-        self.query_name = str(domtblout_line[3])
-        self.query_acc = str(domtblout_line[4])
-        if self.query_acc == '-':
-            self.query_acc = self.query_name
-        self.query_len = int(domtblout_line[5])
-        self.e_value = float(domtblout_line[6])
-        self.bitscore = float(domtblout_line[7])
-        self.bias = float(domtblout_line[8])
-        self.domain_number = int(domtblout_line[9])
-        self.total_domains = int(domtblout_line[10])
-        self.conditional_evalue = float(domtblout_line[11])
-        self.independent_evalue = float(domtblout_line[12])
-        self.domain_bitscore = float(domtblout_line[13])
-        self.domain_bias = float(domtblout_line[14])
-        self.hmm_from = int(domtblout_line[15])
-        self.hmm_to = int(domtblout_line[16])
-        self.ali_from = int(domtblout_line[17])
-        self.ali_to = int(domtblout_line[18])
-        self.env_from = int(domtblout_line[19])
-        self.env_to = int(domtblout_line[20])
-        self.posterior_probability = float(domtblout_line[21])
-        self.description = float(domtblout_line[22])
-        self.target_coverage = float(self.ali_to - self.ali_from + 1) / self.target_len
-        self.query_coverage = float(self.query_to - self.query_from + 1) / self.query_len
+        """Expects a domtblout line, or a list of its 23 elements"""
+        super().__init__(domtblout_line)
+
+    @property
+    def target_acc(self):
+        target_acc = self._fields()[1]
+        if target_acc == '-':
+            return self.target_name # This happens often
+        return target_acc
+
+    @property
+    def query_acc(self):
+        query_acc = self._fields()[4]
+        if query_acc == '-':
+            return self.query_name
+        return query_acc
+
+    @property
+    def target_coverage(self):
+        return float(self.ali_to - self.ali_from + 1) / self.target_len
+
+    @property
+    def query_coverage(self):
+        return float(self.hmm_to - self.hmm_from + 1) / self.query_len
         
                     
 class HmmsearchParser(object):
@@ -73,10 +419,118 @@ class HmmsearchParser(object):
                 if line.startswith('#') or len(line) == 0:
                     continue
                 else:
-                    line = line.rstrip().split()
-                    line = line[0:22] + [' '.join([str(i) for i in line[22:]])]
                     line_parsed = HmmHit(line)
                     hits.append(line_parsed)
         return hits
-                    
-        
\ No newline at end of file
+
+    def iter_chunks(self, chunk_size = 100000, max_evalue = None, max_domain_evalue = None, min_bitscore = None,
+                    min_domain_bitscore = None, min_target_coverage = None, min_query_coverage = None):
+        """Parses the domtblout in chunks of lines, yielding an HmmsearchTable per chunk
+
+        Fields are located across a whole chunk with NumPy rather than by splitting each line,
+        numeric columns are converted one column at a time, and filters are applied before any
+        string columns are built, so rows that fail a filter are never materialized. String
+        columns are dictionary-encoded.
+
+        Args:
+            chunk_size (int, optional): Number of lines per chunk. Defaults to 100000.
+            max_evalue (float, optional): Maximum full-sequence E-value
+            max_domain_evalue (float, optional): Maximum domain independent E-value
+            min_bitscore (float, optional): Minimum full-sequence bitscore
+            min_domain_bitscore (float, optional): Minimum domain bitscore
+            min_target_coverage (float, optional): Minimum fraction of the target covered by the alignment
+            min_query_coverage (float, optional): Minimum fraction of the HMM covered by the alignment
+
+        Yields:
+            HmmsearchTable: Filtered hits for each chunk (may be empty)
+        """
+        import numpy as np
+        with open(self.hmmfile, 'rb') as domtbl:
+            while True:
+                lines = list(itertools.islice(domtbl, chunk_size))
+                if not lines:
+                    break
+                data, starts, ends = split_whitespace_fields(lines, len(DOMTBLOUT_COLUMNS), b'#')
+                del lines
+                if not len(starts):
+                    continue
+                table = HmmsearchTable._from_fields(data, starts, ends)
+                mask = np.ones(len(table), dtype = bool)
+                if max_evalue is not None:
+                    mask &= table['e_value'] <= max_evalue
+                if max_domain_evalue is not None:
+                    mask &= table['independent_evalue'] <= max_domain_evalue
+                if min_bitscore is not None:
+                    mask &= table['bitscore'] >= min_bitscore
+                if min_domain_bitscore is not None:
+                    mask &= table['domain_bitscore'] >= min_domain_bitscore
+                if min_target_coverage is not None:
+                    mask &= table['target_coverage'] >= min_target_coverage
+                if min_query_coverage is not None:
+                    mask &= table['query_coverage'] >= min_query_coverage
+                yield table._add_string_columns(data, starts[mask], ends[mask], mask)
+
+    def parse_columnar(self, best_hit = False, chunk_size = 100000, **filters):
+        """Parses the whole domtblout into a single HmmsearchTable
+
+        Args:
+            best_hit (bool, optional): Keep only the highest domain bitscore hit per target.
+                Applied per chunk as well as at the end, so memory is bounded by the number of targets.
+                Defaults to False.
+            chunk_size (int, optional): Number of lines parsed at a time. Defaults to 100000.
+            **filters: Passed to iter_chunks (max_evalue, min_bitscore, min_query_coverage, ...)
+
+        Returns:
+            HmmsearchTable: All hits passing filters
+        """
+        tables = []
+        for table in self.iter_chunks(chunk_size = chunk_size, **filters):
+            if best_hit:
+                table = HmmsearchTable.concatenate(tables + [table]).best_hit_per_target()
+                tables = []
+            tables.append(table)
+        return HmmsearchTable.concatenate(tables)
+
+
+class HmmsearchTable(ColumnarTable):
+    """Columnar domtblout hits, one NumPy array per HmmHit attribute
+
+    Rows from .rows() or .row(i) expose the same attribute names as HmmHit. String columns are
+    dictionary-encoded, since names repeat across the domains and hits of a target or HMM.
+    """
+    @classmethod
+    def _from_fields(cls, data, starts, ends):
+        """Builds the numeric columns (and coverages) from domtblout field offsets"""
+        columns = {}
+        for i, (name, dtype) in enumerate(DOMTBLOUT_COLUMNS):
+            if dtype is not object:
+                columns[name] = parse_numeric_fields(data, starts[:, i], ends[:, i], dtype)
+        columns['target_coverage'] = (columns['ali_to'] - columns['ali_from'] + 1) / columns['target_len']
+        columns['query_coverage'] = (columns['hmm_to'] - columns['hmm_from'] + 1) / columns['query_len']
+        return cls(columns)
+
+    def _add_string_columns(self, data, starts, ends, mask):
+        """Filters numeric columns by mask and adds string columns from the field offsets of the rows that passed"""
+        import numpy as np
+        table = self.take(mask)
+        # Accessions are often '-', in which case the name is used, as in HmmHit
+        for acc, name in ((1, 0), (4, 3)):
+            missing = (ends[:, acc] - starts[:, acc] == 1) & (np.frombuffer(data, dtype = np.uint8)[starts[:, acc]] == ord('-'))
+            starts[missing, acc] = starts[missing, name]
+            ends[missing, acc] = ends[missing, name]
+        for i, (name, dtype) in enumerate(DOMTBLOUT_COLUMNS):
+            if dtype is object:
+                table.columns[name], table.dictionaries[name] = encode_string_fields(data, starts[:, i], ends[:, i])
+        ordered = {name: table.columns[name] for name, dtype in DOMTBLOUT_COLUMNS}
+        ordered['target_coverage'] = table.columns['target_coverage']
+        ordered['query_coverage'] = table.columns['query_coverage']
+        table.columns = ordered
+        return table
+
+    def best_hit_per_target(self, score_column = 'domain_bitscore'):
+        """Keeps the single best-scoring hit for each target sequence"""
+        return self.top_n_per_group('target_name', score_column, n = 1)
+
+    def to_hits(self):
+        """Converts to a list of lazy row views, for code expecting a list of HmmHits"""
+        return list(self.rows())
@@ -1,12 +1,30 @@
-import os, subprocess
-from bioutils.run_external import path_check
-from bioutils import utilities
+import os, glob, collections
+from bioutils.run_external import instrument
+from bioutils.run_external.path_check import path_check
+from bioutils.run_external.engine import Job
+from bioutils import utilities, fasta_ops
+from bioutils.tables import ColumnarTable, LazyRecord, LazyField, iter_delimited_chunks
+
+# Joins FASTA index and original header in batch query headers
+BATCH_SEPARATOR = '__'
+# Column name and dtype for each field of a search (BLAST OUTFMT6) and taxonomy table, in file order
+SEARCH_COLUMNS = [
+    ('query_name', object), ('target_name', object), ('sequence_identity', 'float64'),
+    ('alignment_len', 'int64'), ('num_mismatch', 'int64'), ('num_gaps', 'int64'),
+    ('query_start', 'int64'), ('query_end', 'int64'), ('target_start', 'int64'), ('target_end', 'int64'),
+    ('e_value', 'float64'), ('bitscore', 'float64'),
+]
+TAXONOMY_COLUMNS = [
+    ('query_name', object), ('ncbi_id', 'int64'), ('ncbi_rank', object), ('ncbi_name', object),
+    ('complete_lineage', object),
+]
 
 class Mmseqs(object):
     """Runs various Mmseqs modules"""
-    def __init__(self, user_path = None, tmp_path = None, mode = 'search', fasta_type = 'nuc'):
+    def __init__(self, user_path = None, tmp_path = None, mode = 'search', fasta_type = 'nuc', cache = None):
         self.user_path = user_path
         self.tmp_path = tmp_path
+        self.cache = cache
         if mode == 'createdb':
             self.mode = 'createdb'
         elif mode == 'search':
@@ -18,84 +36,246 @@ class Mmseqs(object):
         elif fasta_type == 'aa':
             self.fasta_type = 'aa'
         path_check('mmseqs', self.user_path)
-        
+
+    def _run(self, cmd, output, inputs = (), databases = ()):
+        """Runs an MMseqs command unless its output exists, or through the result cache if one is set
+
+        Raises:
+            JobError: If MMseqs fails, with its return code and stderr
+        """
+        if self.cache is not None:
+            ignored = [self.tmp_path] if self.tmp_path is not None else []
+            self.cache.run(cmd, [output], inputs = inputs, databases = databases, ignored = ignored)
+        elif not os.path.exists(output):
+            instrument.check_record(instrument.run_command(cmd, inputs = list(inputs) + list(databases), capture_stderr = True))
+
+    def _createdb_steps(self, input_fasta, output_dir):
+        fname = utilities.remove_extension(input_fasta)
+        outdb = os.path.join(output_dir, fname + '.db')
+        createdb_cmd = ['mmseqs', 'createdb', input_fasta, outdb]
+        return [(createdb_cmd, outdb, [input_fasta], [])]
+
+    def _search_steps(self, query_db, search_db, output_dir, top_hit = True):
+        if self.fasta_type == 'nuc':
+            search_type = '3'
+        else:
+            search_type = '1'
+        query_name = utilities.remove_extension(query_db)
+        search_name = utilities.remove_extension(search_db)
+        outdb = os.path.join(output_dir, query_name + '_' + search_name + '.db')
+        search_cmd = ['mmseqs', 'search', query_db, search_db, outdb, self.tmp_path, '--search-type', search_type]
+        steps = [(search_cmd, outdb, [], [query_db, search_db])]
+        if top_hit:
+            topdb = os.path.join(output_dir, query_name + '_' + search_name + '_top.db')
+            top_hit_cmd = ['mmseqs', 'filterdb', outdb, topdb, '--extract-lines', '1']
+            steps.append((top_hit_cmd, topdb, [], [outdb]))
+            outdb = topdb
+        return steps + self._convert_steps(query_db, search_db, outdb, output_dir)
+
+    def _convert_steps(self, query_db, search_db, hit_db, output_dir):
+        outfmt = os.path.join(output_dir, utilities.remove_extension(hit_db) + '.tab')
+        convert_cmd = ['mmseqs', 'convertalis', query_db, search_db, hit_db, outfmt]
+        return [(convert_cmd, outfmt, [], [query_db, search_db, hit_db])]
+
+    def _taxonomy_steps(self, query_db, search_db, output_dir):
+        query_name = utilities.remove_extension(query_db)
+        search_name = utilities.remove_extension(search_db)
+        outdb = os.path.join(output_dir, query_name + '_' + search_name + '.db')
+        outtsv = os.path.join(output_dir, query_name + '_' + search_name + '.tsv')
+        taxonomy_cmd = ['mmseqs', 'taxonomy', query_db, search_db, outdb, self.tmp_path, '--tax-lineage', '1']
+        tsv_cmd = ['mmseqs', 'createtsv', query_db, outdb, outtsv]
+        return [(taxonomy_cmd, outdb, [], [query_db, search_db]), (tsv_cmd, outtsv, [], [query_db, outdb])]
+
+    def _run_steps(self, steps):
+        for cmd, output, inputs, databases in steps:
+            self._run(cmd, output, inputs = inputs, databases = databases)
+
+    def _steps_job(self, steps, threads, depends_on):
+        """Chains steps into Jobs that each depend on the one before, returning the last
+
+        Every step but createdb is run with --threads set to the threads it reserves from the engine.
+        """
+        ignored = [self.tmp_path] if self.tmp_path is not None else []
+        job = None
+        for cmd, output, inputs, databases in steps:
+            if cmd[1] != 'createdb':
+                cmd = cmd + ['--threads', str(threads)]
+            job = Job(cmd, name = 'mmseqs ' + cmd[1] + ' ' + os.path.basename(output), threads = threads,
+                      depends_on = depends_on if job is None else [job], outputs = [output], inputs = inputs,
+                      databases = databases, ignored = ignored, cache = self.cache)
+        return job
+
     def create_mmseqs_database(self, input_fasta, output_dir):
         """Creates an MMseqs database from an input fasta"""
         if self.mode == 'createdb':
-            fname = utilities.remove_extension(input_fasta)
-            createdb_cmd = ['mmseqs', 'createdb', input_fasta, os.path.join(output_dir, fname + '.db')]
-            if not os.path.exists(os.path.join(output_dir, fname + '.db')):
-                subprocess.run(createdb_cmd)
+            self._run_steps(self._createdb_steps(input_fasta, output_dir))
     
     def search(self, query_db, search_db, output_dir, top_hit = True):
         """Searches input database against a search database and returns a Blast-style OUTFMT6 table"""
         if self.mode == 'search':
-            if self.fasta_type == 'nuc':
-                search_type = '3'
-            else:
-                search_type = '1'
-            query_name = utilities.remove_extension(query_db)
-            search_name = utilities.remove_extension(search_db)
-            outdb = os.path.join(output_dir, query_name + '_' + search_name + '.db')
-            search_cmd = ['mmseqs', 'search', query_db, search_db, outdb, self.tmp_path, '--search-type', search_type]
-            if not os.path.exists(outdb):
-                subprocess.run(search_cmd)
-            if top_hit:
-                topdb = os.path.join(output_dir, query_name + '_' + search_name + '_top.db')
-                top_hit_cmd = ['mmseqs', 'filterdb', outdb, topdb, '--extract-lines', '1']
-                if not os.path.exists(topdb):
-                    subprocess.run(top_hit_cmd)
-                    self.convert_alis(query_db, search_db, topdb, output_dir)
-            else:
-                self.convert_alis(query_db, search_db, outdb)
+            self._run_steps(self._search_steps(query_db, search_db, output_dir, top_hit))
             
     def convert_alis(self, query_db, search_db, hit_db, output_dir):
-        outfmt = os.path.join(output_dir, utilities.remove_extension(hit_db) + '.tab')
-        convert_cmd = ['mmseqs', 'convertalis', query_db, search_db, hit_db, outfmt]
-        if not os.path.exists(outfmt):
-            subprocess.run(convert_cmd)      
+        self._run_steps(self._convert_steps(query_db, search_db, hit_db, output_dir))
     
     def identify_taxonomy(self, query_db, search_db, output_dir):
         if self.mode == 'taxonomy':
-            query_name = utilities.remove_extension(query_db)
-            search_name = utilities.remove_extension(search_db)
-            outdb = os.path.join(output_dir, query_name + '_' + search_name + '.db')
-            outtsv = os.path.join(output_dir, query_name + '_' + search_name + '.tsv')
-            taxonomy_cmd = ['mmseqs', 'taxonomy', query_db, search_db, outtsv, self.tmp_path, '--tax-lineage', '1']
-            tsv_cmd = ['mmseqs', 'createtsv', query_db, outdb, outtsv]
-            if not os.path.exists(outtsv):
-                if not os.path.exists(outdb):
-                    subprocess.run(taxonomy_cmd)
-                subprocess.run(tsv_cmd)
+            steps = self._taxonomy_steps(query_db, search_db, output_dir)
+            if self.cache is not None or not os.path.exists(steps[-1][1]):
+                self._run_steps(steps)
+
+    def createdb_job(self, input_fasta, output_dir, depends_on = ()):
+        """Builds a Job doing the same as create_mmseqs_database, for use with engine.JobEngine"""
+        return self._steps_job(self._createdb_steps(input_fasta, output_dir), 1, depends_on)
+
+    def search_job(self, query_db, search_db, output_dir, top_hit = True, threads = None, depends_on = ()):
+        """Builds a chain of Jobs doing the same as search, for use with engine.JobEngine
+
+        Args:
+            query_db (str): Query MMseqs database
+            search_db (str): Target MMseqs database
+            output_dir (str): Directory for result databases and table
+            top_hit (bool, optional): Keep only the top hit per query. Defaults to True.
+            threads (int, optional): MMseqs --threads, counted against the engine budget. Defaults to None, all cores.
+            depends_on (list, optional): Jobs that must finish first, e.g. createdb_job for the query
+
+        Returns:
+            Job: Final convertalis job, which depends on the earlier steps
+        """
+        return self._steps_job(self._search_steps(query_db, search_db, output_dir, top_hit),
+                               threads or os.cpu_count(), depends_on)
+
+    def taxonomy_job(self, query_db, search_db, output_dir, threads = None, depends_on = ()):
+        """Builds a chain of Jobs doing the same as identify_taxonomy, for use with engine.JobEngine"""
+        return self._steps_job(self._taxonomy_steps(query_db, search_db, output_dir),
+                               threads or os.cpu_count(), depends_on)
+
+    def batch_search(self, query_fastas, search_db, output_dir, top_hit = True, threads = None, keep_hot = True):
+        """Searches many query FASTAs against one target database in a single MMseqs run
+
+        Queries are concatenated into one query database, with each header prefixed by the index
+        of its FASTA (recorded in batch_query.provenance.tsv). The target is indexed once with
+        createindex, which later calls reuse, and searched with --db-load-mode 2 so the index is
+        memory-mapped from the page cache rather than read from disk per run. Hits are then split
+        back into one table per query FASTA, with the original headers. Without a result cache,
+        the batch files left in output_dir by an earlier call are removed first, so they are
+        always rebuilt from the current queries.
+
+        Args:
+            query_fastas (list): Paths to query FASTAs
+            search_db (str): Target MMseqs database
+            output_dir (str): Directory for the batch databases and per-query tables
+            top_hit (bool, optional): Keep only the top hit per query sequence. Defaults to True.
+            threads (int, optional): MMseqs --threads. Defaults to None, all cores.
+            keep_hot (bool, optional): Run touchdb first, preloading the target index into the page cache. Defaults to True.
+
+        Returns:
+            dict: query FASTA path: path to its BLAST-style OUTFMT6 table
+
+        Raises:
+            ValueError: If two query FASTAs share a basename, since their tables would have the same name
+        """
+        query_names = [utilities.retrieve_basename(query_fasta) for query_fasta in query_fastas]
+        duplicates = sorted(name for name, count in collections.Counter(query_names).items() if count > 1)
+        if duplicates:
+            raise ValueError('Query FASTAs must have unique basenames, found duplicates: ' + ', '.join(duplicates))
+        utilities.create_directory(output_dir)
+        if self.cache is None:
+            # Batch files have fixed names, so ones from an earlier call would otherwise be skipped as done
+            for stale_path in glob.glob(os.path.join(output_dir, 'batch_query*')):
+                os.remove(stale_path)
+        thread_args = ['--threads', str(threads)] if threads is not None else []
+        search_type = '3' if self.fasta_type == 'nuc' else '1'
+        batch_fasta = os.path.join(output_dir, 'batch_query.fasta')
+        provenance_tsv = os.path.join(output_dir, 'batch_query.provenance.tsv')
+        with open(batch_fasta, 'w') as outf, open(provenance_tsv, 'w') as provf:
+            for genome_idx, query_fasta in enumerate(query_fastas):
+                provf.write(str(genome_idx) + '\t' + query_fasta + '\n')
+                for header, sequence in fasta_ops.iter_fasta(query_fasta):
+                    outf.write('>' + str(genome_idx) + BATCH_SEPARATOR + header + '\n' + sequence + '\n')
+        query_db = os.path.join(output_dir, 'batch_query.db')
+        self._run(['mmseqs', 'createdb', batch_fasta, query_db], query_db, inputs = [batch_fasta])
+        index_cmd = ['mmseqs', 'createindex', search_db, self.tmp_path, '--search-type', search_type] + thread_args
+        self._run(index_cmd, search_db + '.idx', databases = [search_db])
+        if keep_hot:
+            instrument.check_record(instrument.run_command(['mmseqs', 'touchdb', search_db] + thread_args, inputs = [search_db],
+                                                           threads = threads, capture_stderr = True))
+        steps = self._search_steps(query_db, search_db, output_dir, top_hit)
+        for cmd, output, inputs, databases in steps:
+            if cmd[1] in ('search', 'convertalis'):
+                cmd += ['--db-load-mode', '2'] + thread_args
+            self._run(cmd, output, inputs = inputs, databases = databases)
+        search_name = utilities.remove_extension(search_db)
+        outputs = {query_fasta: os.path.join(output_dir, query_name + '_' + search_name + '.tab')
+                   for query_fasta, query_name in zip(query_fastas, query_names)}
+        split_batch_hits(steps[-1][1], [outputs[query_fasta] for query_fasta in query_fastas])
+        return outputs
+
+
+def split_batch_hits(batch_table, output_tables):
+    """Splits a batch search table into one table per query FASTA, restoring the original query headers
+
+    Args:
+        batch_table (str): Table from a batch search, with query headers prefixed by FASTA index
+        output_tables (list): Output table path for each query FASTA, in batch order
+    """
+    written = set()
+    current_idx = None
+    outf = None
+    try:
+        with open(batch_table, 'r') as inf:
+            for line in inf:
+                genome_idx, line = line.split(BATCH_SEPARATOR, 1)
+                genome_idx = int(genome_idx)
+                if genome_idx != current_idx:
+                    if outf is not None:
+                        outf.close()
+                    # Results are normally grouped by query, so reopening in append mode is rare
+                    outf = open(output_tables[genome_idx], 'a' if genome_idx in written else 'w')
+                    written.add(genome_idx)
+                    current_idx = genome_idx
+                outf.write(line)
+    finally:
+        if outf is not None:
+            outf.close()
+    for genome_idx, output_table in enumerate(output_tables):
+        if genome_idx not in written:
+            open(output_table, 'w').close()
             
         
-class MmseqsTaxonomyHit(object):
+class MmseqsTaxonomyHit(LazyRecord):
     """Stores a single line of an MMseqs taxonomy search"""
+    __slots__ = ()
+    query_name = LazyField(0)
+    ncbi_id = LazyField(1, int)
+    ncbi_rank = LazyField(2)
+    ncbi_name = LazyField(3)
+    complete_lineage = LazyField(4, default = '')
+
     def __init__(self, taxonomy_tsv_line):
-        """Expects a list of 5 elements"""
-        self.query_name = str(taxonomy_tsv_line[0])
-        self.ncbi_id = int(taxonomy_tsv_line[1])
-        self.ncbi_rank = str(taxonomy_tsv_line[2])
-        self.ncbi_name = str(taxonomy_tsv_line[3])
-        self.complete_lineage = taxonomy_tsv_line[5]
+        """Expects a tab-separated line, or a list of its 5 elements"""
+        super().__init__(taxonomy_tsv_line)
 
 
-class MmseqsSearchHit(object):
+class MmseqsSearchHit(LazyRecord):
     """Stores a single line of an MMseqs sequence search"""
+    __slots__ = ()
+    query_name = LazyField(0)
+    target_name = LazyField(1)
+    sequence_identity = LazyField(2, float)
+    alignment_len = LazyField(3, int)
+    num_mismatch = LazyField(4, int)
+    num_gaps = LazyField(5, int)
+    query_start = LazyField(6, int)
+    query_end = LazyField(7, int)
+    target_start = LazyField(8, int)
+    target_end = LazyField(9, int)
+    e_value = LazyField(10, float)
+    bitscore = LazyField(11, float)
+
     def __init__(self, search_tsv_line):
-        """Expects a list of 12 elements"""
-        self.query_name = str(search_tsv_line[0])
-        self.target_name = str(search_tsv_line[1])
-        self.sequence_identity = float(search_tsv_line[2])
-        self.alignment_len = int(search_tsv_line[3])
-        self.num_mismatch = int(search_tsv_line[4])
-        self.num_gaps = int(search_tsv_line[5])
-        self.query_start = int(search_tsv_line[6])
-        self.query_end = int(search_tsv_line[7])
-        self.target_start = int(search_tsv_line[8])
-        self.target_end = int(search_tsv_line[9])
-        self.e_value = float(search_tsv_line[10])
-        self.bitscore = float(search_tsv_line[11])
+        """Expects a tab-separated line, or a list of its 12 elements"""
+        super().__init__(search_tsv_line)
         
   
 class MmseqsParser(object):
@@ -115,13 +295,64 @@ class MmseqsParser(object):
         if self.input_type == 'search':
             with open(self.input_file, 'r') as searchfile:
                 for line in searchfile:
-                    line = line.rstrip().split('\t')
                     line_parsed = MmseqsSearchHit(line)
                     hits.append(line_parsed)
         elif self.input_type == 'taxonomy':
             with open(self.input_file, 'r') as taxfile:
                 for line in taxfile:
-                    line = line.rstrip().split('\t')
                     line_parsed = MmseqsTaxonomyHit(line)
                     hits.append(line_parsed)
-        return hits
\ No newline at end of file
+        return hits
+
+    def iter_chunks(self, chunk_size = 100000, usecols = None, min_identity = None, max_evalue = None,
+                    min_bitscore = None):
+        """Reads the table in fixed-size chunks of typed columns, with optional filters
+
+        Args:
+            chunk_size (int, optional): Lines per chunk. Defaults to 100000.
+            usecols (list, optional): Columns to keep (e.g. ['query_name', 'bitscore']). Defaults to None, all.
+                Columns used by filters are always read.
+            min_identity (float, optional): Minimum sequence identity (search tables only)
+            max_evalue (float, optional): Maximum E-value (search tables only)
+            min_bitscore (float, optional): Minimum bitscore (search tables only)
+
+        Yields:
+            ColumnarTable: Filtered rows of each chunk
+        """
+        import numpy as np
+        columns = SEARCH_COLUMNS if self.input_type == 'search' else TAXONOMY_COLUMNS
+        filters = [('sequence_identity', min_identity, np.greater_equal), ('e_value', max_evalue, np.less_equal),
+                   ('bitscore', min_bitscore, np.greater_equal)]
+        filters = [(name, value, compare) for name, value, compare in filters if value is not None]
+        readcols = None
+        if usecols is not None:
+            readcols = list(usecols) + [name for name, value, compare in filters if name not in usecols]
+        for table in iter_delimited_chunks(self.input_file, columns, chunk_size, readcols):
+            if filters:
+                mask = np.ones(len(table), dtype = bool)
+                for name, value, compare in filters:
+                    mask &= compare(table[name], value)
+                table = table.take(mask)
+            if usecols is not None:
+                table = table.select(usecols)
+            yield table
+
+    def top_hits(self, n = 1, score_column = 'bitscore', chunk_size = 100000, **kwargs):
+        """Keeps the n best hits per query, reducing chunk by chunk so memory is bounded by queries x n
+
+        Args:
+            n (int, optional): Hits to keep per query. Defaults to 1.
+            score_column (str, optional): Column to rank by, highest first. Defaults to 'bitscore'.
+            chunk_size (int, optional): Lines per chunk. Defaults to 100000.
+            **kwargs: Passed to iter_chunks (usecols, min_identity, max_evalue, min_bitscore)
+
+        Returns:
+            ColumnarTable: Best hits, sorted by query then score
+        """
+        usecols = kwargs.pop('usecols', None)
+        if usecols is not None:
+            usecols = list(usecols) + [name for name in ('query_name', score_column) if name not in usecols]
+        best = ColumnarTable({})
+        for table in self.iter_chunks(chunk_size, usecols, **kwargs):
+            best = ColumnarTable.concatenate([best, table]).top_n_per_group('query_name', score_column, n)
+        return best
@@ -1,18 +1,30 @@
-import os, subprocess
-from bioutils.run_external import path_check
+import os, re, shutil, tempfile, collections
+from concurrent.futures import ThreadPoolExecutor
+from bioutils import fasta_ops, utilities
+from bioutils.run_external import instrument
+from bioutils.run_external.path_check import path_check
+from bioutils.run_external.engine import Job
+
+# Sequence numbers Prodigal writes into gene IDs (ID=3_12) and GBK DEFINITION lines (seqnum=3)
+SEQNUM_PATTERN = re.compile(r'(ID=|seqnum=)(\d+)')
+# Prodigal reads plain FASTA only, so inputs ending in these are decompressed first
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
 
 class Prodigal(object):
     """Runs Prodigal"""
-    def __init__(self, user_path = None, id_type = 'meta', verbose = True):
+    def __init__(self, user_path = None, id_type = 'meta', verbose = True, cache = None):
         """Class for running Prodigal for CDS prediction
 
         Args:
             user_path (str, optional): Path for calling Prodigal. Defaults to None, which is the base Path.
             id_type (str, optional): Which mode Prodigal runs in, either 'single' (isolate genome) or 'meta'. Defaults to 'meta'.
             verbose (bool, optional): If true, prints Prodigal output to console. Defaults to True.
+            cache (ResultCache, optional): Cache to reuse results of identical runs. Defaults to None,
+                which skips runs whose outputs exist.
         """
         self.user_path = user_path
         self.verbose = verbose
+        self.cache = cache
         path_check('prodigal', self.user_path)
         if id_type == 'meta':
             self.id_type = 'meta'
@@ -26,10 +38,175 @@ class Prodigal(object):
             input_fasta (str): Path to input nucleotide FASTA
             output_gbk (str): Path to place output GBK
             output_aa (str): Path to place output amino acid FASTA
+
+        Raises:
+            JobError: If Prodigal fails, with its return code and stderr (unless verbose, which leaves it on the console)
         """
+        prodigal_cmd = self._prodigal_cmd(input_fasta, output_gbk, output_aa)
+        if self.cache is not None:
+            self.cache.run(prodigal_cmd, [output_gbk, output_aa], inputs = [input_fasta])
+        elif not os.path.exists(output_gbk) and not os.path.exists(output_aa):
+            instrument.check_record(instrument.run_command(prodigal_cmd, inputs = [input_fasta], threads = 1,
+                                                           capture_stderr = not self.verbose))
+
+    def _prodigal_cmd(self, input_fasta, output_gbk, output_aa):
         if self.verbose:
             prodigal_cmd = ['prodigal', '-i', input_fasta, '-o', output_gbk, '-a', output_aa, '-p', self.id_type]
         else:
             prodigal_cmd = ['prodigal', '-i', input_fasta, '-o', output_gbk, '-a', output_aa, '-p', self.id_type, '-q']
-        if not os.path.exists(output_gbk) and not os.path.exists(output_aa):
-            subprocess.run(prodigal_cmd)    
+        return prodigal_cmd
+
+    def prodigal_job(self, input_fasta, output_gbk, output_aa, depends_on = ()):
+        """Builds a Job running the same prediction as run_prodigal, for use with engine.JobEngine
+
+        Args:
+            input_fasta (str): Path to input nucleotide FASTA
+            output_gbk (str): Path to place output GBK
+            output_aa (str): Path to place output amino acid FASTA
+            depends_on (list, optional): Jobs that must finish first
+
+        Returns:
+            Job: Awaitable job
+        """
+        prodigal_cmd = self._prodigal_cmd(input_fasta, output_gbk, output_aa)
+        return Job(prodigal_cmd, name = 'prodigal ' + os.path.basename(input_fasta), threads = 1,
+                   depends_on = depends_on, outputs = [output_gbk, output_aa], inputs = [input_fasta],
+                   cache = self.cache)
+
+    def run_prodigal_batch(self, input_fastas, output_dir, processes = None, split_size = None):
+        """Runs Prodigal on many genomes in parallel, writing <genome>.gbk and <genome>.faa to output_dir
+
+        Prodigal is single-threaded, so one run is scheduled per core. Genomes are started
+        largest first, which keeps the last few cores from idling on one big genome. In meta
+        mode, genomes larger than split_size are split into contig chunks that run in parallel
+        and are concatenated afterwards, renumbering gene IDs so they match a run on the whole file.
+        Compressed FASTAs are decompressed to temporary files, and named without the compression
+        extension (x.fna.gz writes x.gbk and x.faa).
+
+        Args:
+            input_fastas (str or list): Directory of nucleotide FASTAs, or list of paths
+            output_dir (str): Directory to write outputs to
+            processes (int, optional): Maximum concurrent Prodigal runs. Defaults to None, which is all cores.
+            split_size (int, optional): In meta mode, split genomes whose files are larger than this many bytes
+                into chunks of about this many residues. Defaults to None, never split.
+
+        Returns:
+            dict: input FASTA path: (output GBK path, output amino acid FASTA path)
+
+        Raises:
+            JobError: If any Prodigal run fails
+        """
+        if isinstance(input_fastas, str):
+            input_fastas = [os.path.join(input_fastas, fname) for fname in sorted(os.listdir(input_fastas))
+                            if fname.endswith(fasta_ops.FASTA_EXTENSIONS)]
+        genome_names = [_genome_name(input_fasta) for input_fasta in input_fastas]
+        duplicates = sorted(name for name, count in collections.Counter(genome_names).items() if count > 1)
+        if duplicates:
+            raise ValueError('Input FASTAs must have unique names, but these are shared: ' + ', '.join(duplicates))
+        os.makedirs(output_dir, exist_ok = True)
+        outputs = {}
+        tasks = []
+        merges = []
+        chunk_dir = tempfile.mkdtemp(prefix = 'prodigal_chunks_', dir = output_dir)
+        try:
+            for input_fasta, genome_name in zip(input_fastas, genome_names):
+                output_gbk = os.path.join(output_dir, genome_name + '.gbk')
+                output_aa = os.path.join(output_dir, genome_name + '.faa')
+                outputs[input_fasta] = (output_gbk, output_aa)
+                if self.cache is None and (os.path.exists(output_gbk) or os.path.exists(output_aa)):
+                    continue
+                size = os.path.getsize(input_fasta)
+                if split_size is not None and self.id_type == 'meta' and size > split_size:
+                    chunks = split_fasta_into_chunks(input_fasta, os.path.join(chunk_dir, genome_name), split_size)
+                    for chunk_fasta, chunk_residues, contig_offset in chunks:
+                        tasks.append((chunk_residues, chunk_fasta, chunk_fasta + '.gbk', chunk_fasta + '.faa'))
+                    merges.append((chunks, output_gbk, output_aa))
+                else:
+                    tasks.append((size, input_fasta, output_gbk, output_aa))
+            tasks.sort(key = lambda task: task[0], reverse = True)
+
+            def run_task(task):
+                size, input_fasta, output_gbk, output_aa = task
+                if input_fasta.endswith(COMPRESSED_EXTENSIONS):
+                    plain_fasta = os.path.join(chunk_dir, _genome_name(input_fasta) + '.fna')
+                    with utilities.open_compressed(input_fasta) as inf, open(plain_fasta, 'wb') as outf:
+                        shutil.copyfileobj(inf, outf, 1024 * 1024)
+                    try:
+                        self.run_prodigal(plain_fasta, output_gbk, output_aa)
+                    finally:
+                        os.remove(plain_fasta)
+                else:
+                    self.run_prodigal(input_fasta, output_gbk, output_aa)
+
+            with ThreadPoolExecutor(processes or os.cpu_count()) as executor:
+                # Consuming the results raises the first failed run's JobError before any merge
+                list(executor.map(run_task, tasks))
+            for chunks, output_gbk, output_aa in merges:
+                concatenate_chunk_outputs(chunks, output_gbk, output_aa)
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors = True)
+        return outputs
+
+
+def _genome_name(input_fasta):
+    """Base name of a FASTA without its extension, or its compression and FASTA extensions"""
+    if input_fasta.endswith(COMPRESSED_EXTENSIONS):
+        input_fasta = os.path.splitext(input_fasta)[0]
+    return utilities.retrieve_basename(input_fasta)
+
+
+def split_fasta_into_chunks(input_fasta, chunk_prefix, split_size):
+    """Splits a FASTA into consecutive chunks of whole contigs of about split_size residues
+
+    Args:
+        input_fasta (str): Path to input FASTA
+        chunk_prefix (str): Path prefix for chunk FASTAs
+        split_size (int): Target residues per chunk
+
+    Returns:
+        list: (chunk FASTA path, residues in chunk, number of contigs before the chunk) for each chunk
+    """
+    chunks = []
+    outf = None
+    residues = 0
+    num_contigs = 0
+    for header, sequence in fasta_ops.iter_fasta(input_fasta):
+        if outf is None or residues >= split_size:
+            if outf is not None:
+                outf.close()
+                chunks[-1][1] = residues
+            chunk_fasta = chunk_prefix + '_chunk' + str(len(chunks)) + '.fna'
+            outf = open(chunk_fasta, 'w')
+            chunks.append([chunk_fasta, 0, num_contigs])
+            residues = 0
+        outf.write('>' + header + '\n' + sequence + '\n')
+        residues += len(sequence)
+        num_contigs += 1
+    if outf is not None:
+        outf.close()
+        chunks[-1][1] = residues
+    return [tuple(chunk) for chunk in chunks]
+
+
+def _renumber(line, contig_offset):
+    """Shifts Prodigal sequence numbers in a line by the number of contigs in earlier chunks"""
+    return SEQNUM_PATTERN.sub(lambda match: match.group(1) + str(int(match.group(2)) + contig_offset), line)
+
+
+def concatenate_chunk_outputs(chunks, output_gbk, output_aa):
+    """Concatenates per-chunk Prodigal outputs in chunk order with genome-wide gene IDs
+
+    Args:
+        chunks (list): (chunk FASTA path, residues, contig offset) as returned by split_fasta_into_chunks
+        output_gbk (str): Path to write merged GBK
+        output_aa (str): Path to write merged amino acid FASTA
+    """
+    for suffix, output in (('.gbk', output_gbk), ('.faa', output_aa)):
+        with open(output + '.tmp', 'w') as outf:
+            for chunk_fasta, chunk_residues, contig_offset in chunks:
+                with open(chunk_fasta + suffix, 'r') as inf:
+                    for line in inf:
+                        if suffix == '.gbk' or line.startswith('>'):
+                            line = _renumber(line, contig_offset)
+                        outf.write(line)
+        os.replace(output + '.tmp', output)
@@ -0,0 +1,139 @@
+"""Single-pass sequence statistics (Nx/Lx, lengths, GC, ambiguous bases) for FASTA files
+
+Lengths are accumulated into a compact integer array and base composition is counted on raw
+bytes with NumPy, so a file is streamed once and never held in memory.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bioutils import fasta_ops
+
+# Sequences are counted in batches of roughly this many bytes to amortize bincount calls
+COUNT_BATCH_BYTES = 8 * 1024 * 1024
+
+
+class SequenceStats(object):
+    """Stores length and base composition statistics for a set of sequences"""
+    def __init__(self, lengths, base_counts, input_fasta = None):
+        """Built from per-sequence lengths and byte counts
+
+        Args:
+            lengths (numpy.ndarray): Length of every sequence, in file order
+            base_counts (numpy.ndarray): Counts of each byte value (256 entries) over all sequences
+            input_fasta (str, optional): Path the statistics were computed from
+        """
+        self.input_fasta = input_fasta
+        self.lengths = lengths
+        self.base_counts = base_counts
+        self.sorted_lengths = np.sort(lengths)[::-1]
+        self.cumulative_lengths = np.cumsum(self.sorted_lengths)
+        self.num_sequences = int(len(lengths))
+        self.total_length = int(self.cumulative_lengths[-1]) if self.num_sequences else 0
+        self.longest = int(self.sorted_lengths[0]) if self.num_sequences else 0
+        self.shortest = int(self.sorted_lengths[-1]) if self.num_sequences else 0
+        self.mean_length = self.total_length / self.num_sequences if self.num_sequences else 0.0
+        acgt = self.count_bases('ACGT')
+        self.gc_count = self.count_bases('GC')
+        self.gc = self.gc_count / acgt if acgt else 0.0
+        self.n_count = self.count_bases('N')
+        self.ambiguous_bases = self.total_length - acgt
+        self.n50 = self.nx(50)
+        self.n90 = self.nx(90)
+        self.l50 = self.lx(50)
+        self.l90 = self.lx(90)
+
+    def count_bases(self, bases):
+        """Counts occurrences of the given bases, case-insensitively"""
+        codes = {ord(base) for base in bases.upper() + bases.lower()}
+        return int(self.base_counts[sorted(codes)].sum())
+
+    def _x_index(self, x):
+        threshold = self.total_length * x / 100
+        return int(np.searchsorted(self.cumulative_lengths, threshold, side = 'left'))
+
+    def nx(self, x):
+        """Length of the shortest sequence among the longest ones covering x% of total length"""
+        if not self.num_sequences:
+            return None
+        return int(self.sorted_lengths[self._x_index(x)])
+
+    def lx(self, x):
+        """Number of the longest sequences needed to cover x% of total length"""
+        if not self.num_sequences:
+            return None
+        return self._x_index(x) + 1
+
+    def length_histogram(self, bins = None):
+        """Histogram of sequence lengths
+
+        Args:
+            bins (int or sequence, optional): Passed to numpy.histogram. Defaults to None,
+                which uses power-of-ten bin edges covering all lengths.
+
+        Returns:
+            tuple: (counts, bin_edges) numpy arrays
+        """
+        if bins is None:
+            upper = max(1, int(np.ceil(np.log10(max(self.longest, 1) + 1))))
+            bins = np.concatenate([[0], 10 ** np.arange(0, upper + 1)])
+        return np.histogram(self.lengths, bins = bins)
+
+    def as_dict(self):
+        """Summary statistics as a plain dict"""
+        return {
+            'input_fasta': self.input_fasta,
+            'num_sequences': self.num_sequences,
+            'total_length': self.total_length,
+            'longest': self.longest,
+            'shortest': self.shortest,
+            'mean_length': self.mean_length,
+            'n50': self.n50,
+            'n90': self.n90,
+            'l50': self.l50,
+            'l90': self.l90,
+            'gc': self.gc,
+            'n_count': self.n_count,
+            'ambiguous_bases': self.ambiguous_bases,
+        }
+
+
+def calculate_stats(input_fasta, threads = 1):
+    """Computes SequenceStats for a FASTA in one streaming pass
+
+    Args:
+        input_fasta (str): Path to input FASTA (plain or compressed)
+        threads (int, optional): Number of decompression threads. Defaults to 1.
+
+    Returns:
+        SequenceStats: Statistics for every sequence in the file
+    """
+    lengths = array('q')
+    base_counts = np.zeros(256, dtype = np.int64)
+    batch = []
+    batch_bytes = 0
+    for header, sequence in fasta_ops._iter_fasta_bytes(input_fasta, threads):
+        lengths.append(len(sequence))
+        batch.append(sequence)
+        batch_bytes += len(sequence)
+        if batch_bytes >= COUNT_BATCH_BYTES:
+            base_counts += np.bincount(np.frombuffer(b''.join(batch), dtype = np.uint8), minlength = 256)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        base_counts += np.bincount(np.frombuffer(b''.join(batch), dtype = np.uint8), minlength = 256)
+    return SequenceStats(np.frombuffer(lengths, dtype = np.int64), base_counts, input_fasta)
+
+
+def calculate_stats_many(input_fastas, processes = None):
+    """Computes SequenceStats for many FASTAs in parallel
+
+    Args:
+        input_fastas (list): Paths to input FASTAs
+        processes (int, optional): Number of worker processes. Defaults to None, which uses all cores.
+
+    Returns:
+        dict: input FASTA path: SequenceStats
+    """
+    with ProcessPoolExecutor(processes) as executor:
+        results = executor.map(calculate_stats, input_fastas, chunksize = 4)
+        return dict(zip(input_fastas, results))
@@ -0,0 +1,258 @@
+"""FracMinHash k-mer sketches for fast genome comparison and dereplication
+
+A sketch keeps every canonical k-mer whose 64-bit hash falls below 2**64 / scaled, so about one in
+`scaled` k-mers. Sketches of different genomes are directly comparable, and their overlap estimates
+Jaccard similarity, containment and ANI without aligning anything. K-mers are encoded, hashed and
+filtered with NumPy over whole sequences at a time.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bioutils import fasta_ops, utilities
+from bioutils.run_external import cache as result_cache
+
+# Maps bytes to 2-bit codes (A=0, C=1, G=2, T=3), anything else to 4
+_ENCODE_LUT = np.full(256, 4, dtype = np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _base in _bases:
+        _ENCODE_LUT[ord(_base)] = _code
+# Sequences are sketched in batches of about this many bases to bound memory on large contigs
+SKETCH_BATCH_BASES = 16 * 1024 * 1024
+
+
+def _mix64(values):
+    """MurmurHash3 64-bit finalizer, applied elementwise with wrapping uint64 arithmetic"""
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def kmer_hashes(sequence, k = 21, max_hash = None):
+    """Hashes the canonical k-mers of a sequence
+
+    Args:
+        sequence (bytes): Nucleotide sequence
+        k (int, optional): k-mer size, at most 32. Defaults to 21.
+        max_hash (int, optional): Only return hashes below this. Defaults to None, all hashes.
+
+    Returns:
+        numpy.ndarray: uint64 hashes of k-mers without ambiguous bases, in sequence order
+    """
+    if not 0 < k <= 32:
+        raise ValueError('k must be between 1 and 32')
+    codes = _ENCODE_LUT[np.frombuffer(sequence, dtype = np.uint8)]
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return np.empty(0, dtype = np.uint64)
+    invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.minimum(codes, 3).astype(np.uint64)
+    forward = np.zeros(num_kmers, dtype = np.uint64)
+    reverse = np.zeros(num_kmers, dtype = np.uint64)
+    for j in range(k):
+        window = codes[j:j + num_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * j)
+    hashes = _mix64(np.minimum(forward, reverse)[valid])
+    if max_hash is not None:
+        hashes = hashes[hashes < np.uint64(max_hash)]
+    return hashes
+
+
+class Sketch(object):
+    """FracMinHash sketch of one genome: the sorted, unique k-mer hashes below a threshold"""
+    def __init__(self, hashes, k, scaled, name = None, source = None, fingerprint = None):
+        self.hashes = hashes
+        self.k = k
+        self.scaled = scaled
+        self.name = name
+        # Path and content fingerprint of the sketched FASTA, checked when a stored sketch is reused
+        self.source = source
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __repr__(self):
+        return 'Sketch(' + repr(self.name) + ', k=' + str(self.k) + ', scaled=' + str(self.scaled) + ', hashes=' + str(len(self)) + ')'
+
+    def save(self, sketch_path):
+        """Saves the sketch as a NumPy .npz file"""
+        with open(sketch_path, 'wb') as outf:
+            np.savez(outf, hashes = self.hashes, k = self.k, scaled = self.scaled, name = str(self.name),
+                     source = str(self.source or ''), fingerprint = str(self.fingerprint or ''))
+
+    @classmethod
+    def load(cls, sketch_path):
+        """Loads a sketch saved with save"""
+        with np.load(sketch_path) as data:
+            source = str(data['source']) if 'source' in data else ''
+            fingerprint = str(data['fingerprint']) if 'fingerprint' in data else ''
+            return cls(data['hashes'], int(data['k']), int(data['scaled']), str(data['name']),
+                       source or None, fingerprint or None)
+
+
+def sketch_fasta(input_fasta, k = 21, scaled = 1000):
+    """Builds a FracMinHash sketch of a nucleotide FASTA in one streaming pass
+
+    Args:
+        input_fasta (str): Path to nucleotide FASTA
+        k (int, optional): k-mer size, at most 32. Defaults to 21.
+        scaled (int, optional): Keep about 1 in scaled k-mers. Defaults to 1000.
+
+    Returns:
+        Sketch: Sketch named after the FASTA's basename
+    """
+    max_hash = 2 ** 64 // scaled
+    kept = []
+    for header, sequence in fasta_ops._iter_fasta_bytes(input_fasta):
+        for start in range(0, max(len(sequence) - k + 1, 1), SKETCH_BATCH_BASES):
+            # Batches overlap by k - 1 bases so no k-mer is lost at a boundary
+            kept.append(kmer_hashes(sequence[start:start + SKETCH_BATCH_BASES + k - 1], k, max_hash))
+    hashes = np.unique(np.concatenate(kept)) if kept else np.empty(0, dtype = np.uint64)
+    return Sketch(hashes, k, scaled, utilities.retrieve_basename(input_fasta), os.path.abspath(input_fasta))
+
+
+def _load_or_sketch(input_fasta, k, scaled, sketch_dir):
+    if sketch_dir is None:
+        return sketch_fasta(input_fasta, k, scaled)
+    # Stored sketches are keyed on content, so same-named genomes in different directories never collide
+    fingerprint = result_cache.file_fingerprint(input_fasta)
+    sketch_path = os.path.join(sketch_dir, fingerprint + '.k' + str(k) + '.s' + str(scaled) + '.npz')
+    if os.path.exists(sketch_path):
+        sketch = Sketch.load(sketch_path)
+        if sketch.fingerprint == fingerprint:
+            sketch.name = utilities.retrieve_basename(input_fasta)
+            sketch.source = os.path.abspath(input_fasta)
+            return sketch
+    sketch = sketch_fasta(input_fasta, k, scaled)
+    sketch.fingerprint = fingerprint
+    sketch.save(sketch_path)
+    return sketch
+
+
+def sketch_many(input_fastas, k = 21, scaled = 1000, sketch_dir = None, processes = None):
+    """Sketches many FASTAs in parallel, reusing sketches stored in sketch_dir
+
+    Args:
+        input_fastas (list): Paths to nucleotide FASTAs
+        k (int, optional): k-mer size. Defaults to 21.
+        scaled (int, optional): Keep about 1 in scaled k-mers. Defaults to 1000.
+        sketch_dir (str, optional): Directory to store and reuse sketches in, keyed on each FASTA's
+            content fingerprint. Defaults to None, sketches are not stored.
+        processes (int, optional): Number of worker processes. Defaults to None, all cores.
+
+    Returns:
+        list: Sketch for each input FASTA, in order
+    """
+    if sketch_dir is not None:
+        os.makedirs(sketch_dir, exist_ok = True)
+    n = len(input_fastas)
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(_load_or_sketch, input_fastas, [k] * n, [scaled] * n, [sketch_dir] * n))
+
+
+def intersection_matrix(sketches, block_size = None):
+    """Counts shared hashes between every pair of sketches
+
+    Sketches are turned into a genomes x hashes 0/1 matrix, one block of hashes at a time, and
+    multiplied with its transpose, so the all-vs-all comparison runs as dense matrix products.
+
+    Args:
+        sketches (list): Sketches with the same k and scaled
+        block_size (int, optional): Distinct hashes per block. Defaults to None, sized to about 256 MB per block.
+
+    Returns:
+        numpy.ndarray: (n, n) int64 matrix of shared hash counts, with sketch sizes on the diagonal
+    """
+    if len({(sketch.k, sketch.scaled) for sketch in sketches}) > 1:
+        raise ValueError('Sketches must share k and scaled to be compared')
+    n = len(sketches)
+    all_hashes = np.concatenate([sketch.hashes for sketch in sketches]) if n else np.empty(0, dtype = np.uint64)
+    owners = np.repeat(np.arange(n), [len(sketch) for sketch in sketches])
+    unique_hashes, columns = np.unique(all_hashes, return_inverse = True)
+    if block_size is None:
+        block_size = max(1024, (256 * 1024 * 1024) // (4 * max(n, 1)))
+    intersections = np.zeros((n, n), dtype = np.float64)
+    order = np.argsort(columns, kind = 'stable')
+    columns, owners = columns[order], owners[order]
+    bounds = np.searchsorted(columns, np.arange(0, len(unique_hashes) + block_size, block_size))
+    for block_start, block_end in zip(bounds[:-1], bounds[1:]):
+        if block_start == block_end:
+            continue
+        block = np.zeros((n, block_size), dtype = np.float32)
+        block[owners[block_start:block_end], columns[block_start:block_end] % block_size] = 1
+        intersections += block @ block.T
+    return np.rint(intersections).astype(np.int64)
+
+
+def similarity_matrices(sketches):
+    """Estimates pairwise similarity between sketches
+
+    Returns:
+        dict: 'jaccard', 'containment' (shared / smaller sketch) and 'ani' (containment ANI, C ** (1/k)) matrices
+    """
+    intersections = intersection_matrix(sketches)
+    sizes = np.diag(intersections).astype(np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        union = sizes[:, None] + sizes[None, :] - intersections
+        jaccard = np.where(union > 0, intersections / union, 0.0)
+        smaller = np.minimum(sizes[:, None], sizes[None, :])
+        containment = np.where(smaller > 0, intersections / smaller, 0.0)
+    k = sketches[0].k if sketches else 21
+    return {'jaccard': jaccard, 'containment': containment, 'ani': containment ** (1.0 / k)}
+
+
+def greedy_cluster(ani, scores, ani_threshold = 0.95):
+    """Greedily clusters genomes, taking representatives in order of decreasing score
+
+    Each genome joins the representative it is most similar to if that is at or above the threshold,
+    otherwise it becomes a new representative.
+
+    Args:
+        ani (numpy.ndarray): (n, n) ANI matrix
+        scores (sequence): Quality score for each genome, higher is better
+        ani_threshold (float, optional): Minimum ANI to join a cluster. Defaults to 0.95.
+
+    Returns:
+        dict: representative index: list of member indices (including the representative)
+    """
+    clusters = {}
+    representatives = []
+    for idx in np.argsort(-np.asarray(scores, dtype = np.float64), kind = 'stable'):
+        idx = int(idx)
+        if representatives:
+            similarities = ani[idx, representatives]
+            best = int(np.argmax(similarities))
+            if similarities[best] >= ani_threshold:
+                clusters[representatives[best]].append(idx)
+                continue
+        representatives.append(idx)
+        clusters[idx] = [idx]
+    return clusters
+
+
+def dereplicate(input_fastas, ani_threshold = 0.95, scores = None, k = 21, scaled = 1000, sketch_dir = None,
+                processes = None):
+    """Clusters near-identical genomes so only one representative per cluster goes on to expensive tools
+
+    Args:
+        input_fastas (list): Paths to nucleotide FASTAs
+        ani_threshold (float, optional): Minimum estimated ANI to cluster genomes. Defaults to 0.95.
+        scores (sequence, optional): Quality score per genome, used to pick representatives. Defaults
+            to None, which prefers larger sketches (bigger genomes).
+        k (int, optional): k-mer size. Defaults to 21.
+        scaled (int, optional): Keep about 1 in scaled k-mers. Defaults to 1000.
+        sketch_dir (str, optional): Directory to store and reuse sketches in. Defaults to None.
+        processes (int, optional): Number of worker processes for sketching. Defaults to None, all cores.
+
+    Returns:
+        dict: representative FASTA path: list of member FASTA paths
+    """
+    sketches = sketch_many(input_fastas, k, scaled, sketch_dir, processes)
+    if scores is None:
+        scores = [len(sketch) for sketch in sketches]
+    clusters = greedy_cluster(similarity_matrices(sketches)['ani'], scores, ani_threshold)
+    return {input_fastas[rep]: [input_fastas[member] for member in members] for rep, members in clusters.items()}
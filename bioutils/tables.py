@@ -0,0 +1,401 @@
+"""Columnar (struct-of-arrays) tables for large tool outputs
+
+Each column is a NumPy array, so millions of rows cost a few bytes per numeric field instead of a
+Python object per row. Repetitive string columns can be dictionary-encoded, storing int32 codes
+into a small array of unique strings. Rows can still be viewed one at a time with attribute access.
+"""
+import itertools
+
+# Fields wider than this are dictionary-encoded from Python slices rather than a fixed-width copy
+MAX_GATHER_WIDTH = 64
+
+
+class LazyField(object):
+    """Descriptor that decodes one field of a LazyRecord's line when first accessed"""
+    __slots__ = ('index', 'converter', 'default')
+
+    def __init__(self, index, converter = str, default = None):
+        """Describes a field
+
+        Args:
+            index (int): Position of the field in the split line
+            converter (callable, optional): Converts the field's text. Defaults to str.
+            default (optional): Value returned if the line has too few fields. Defaults to None,
+                which raises IndexError instead.
+        """
+        self.index = index
+        self.converter = converter
+        self.default = default
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        values = record._values
+        if values is None:
+            values = record._fields()
+        try:
+            value = values[self.index]
+        except IndexError:
+            if self.default is None:
+                raise
+            return self.default
+        if self.converter is not str and type(value) is str:
+            # Converted once, then kept in place of the text
+            value = values[self.index] = self.converter(value)
+        return value
+
+
+class LazyRecord(object):
+    """One line of a tool's tabular output, kept as the original text and decoded field by field on access
+
+    A record holds a single string and no __dict__, several times smaller than storing every
+    field as its own attribute, and columns that are never read are never converted. The line is
+    split on the first access and each field is converted on its first read, so repeated reads
+    are a list lookup.
+    """
+    __slots__ = ('_line', '_values')
+    # Passed to str.split; None splits on runs of whitespace
+    delimiter = '\t'
+    maxsplit = -1
+
+    def __init__(self, line):
+        """Built from a line of text, or a list of its already split fields"""
+        if not isinstance(line, str):
+            line = (self.delimiter or ' ').join(str(field) for field in line)
+        elif self.delimiter is None:
+            # Column-aligned outputs are mostly padding, so store single-space separated fields
+            line = ' '.join(line.split(None, self.maxsplit))
+        self._line = line.rstrip('\n')
+        self._values = None
+
+    def _fields(self):
+        """Returns the split fields, keeping any already converted by a LazyField"""
+        if self._values is None:
+            self._values = self._line.split(self.delimiter, self.maxsplit)
+        return self._values
+
+    def __repr__(self):
+        return type(self).__name__ + '(' + repr(self._line) + ')'
+
+
+class TableRow(object):
+    """Lazy view of one row of a ColumnarTable, exposing columns as attributes"""
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        import numpy as np
+        try:
+            column = self._table.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = column[self._index]
+        if name in self._table.dictionaries:
+            return self._table.dictionaries[name][value]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __repr__(self):
+        fields = ', '.join(name + '=' + repr(getattr(self, name)) for name in self._table.column_names)
+        return type(self).__name__ + '(' + fields + ')'
+
+
+class ColumnarTable(object):
+    """Stores a table as a dict of equal-length NumPy arrays
+
+    A dictionary-encoded column holds int32 codes in columns and its sorted unique values in
+    dictionaries, so codes order like the values they stand for. Indexing the table by name
+    decodes the column, while methods grouping or sorting rows work on the codes.
+    """
+    def __init__(self, columns, dictionaries = None):
+        """Built from a dict of column name: numpy.ndarray, and of column name: sorted unique values
+        for dictionary-encoded columns"""
+        self.columns = dict(columns)
+        self.dictionaries = dict(dictionaries or {})
+
+    @property
+    def column_names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name):
+        if name in self.dictionaries:
+            return self.dictionaries[name][self.columns[name]]
+        return self.columns[name]
+
+    def __iter__(self):
+        return self.rows()
+
+    def row(self, index):
+        """Returns a lazy attribute view of one row"""
+        return TableRow(self, index)
+
+    def rows(self):
+        """Yields lazy attribute views of every row"""
+        for index in range(len(self)):
+            yield TableRow(self, index)
+
+    def take(self, selection):
+        """Returns a new table of the same type with rows selected by a boolean mask or index array"""
+        return type(self)({name: column[selection] for name, column in self.columns.items()}, self.dictionaries)
+
+    def select(self, column_names):
+        """Returns a new table with only the given columns"""
+        return type(self)({name: self.columns[name] for name in column_names},
+                          {name: self.dictionaries[name] for name in column_names if name in self.dictionaries})
+
+    def top_n_per_group(self, group_column, score_column, n = 1, descending = True):
+        """Keeps the n best-scoring rows for each value of a grouping column
+
+        Args:
+            group_column (str): Column to group rows by (e.g. query name)
+            score_column (str): Column to rank rows by within a group
+            n (int, optional): Number of rows to keep per group. Defaults to 1.
+            descending (bool, optional): Keep highest scores if True, else lowest. Defaults to True.
+
+        Returns:
+            ColumnarTable: Reduced table sorted by group, then score
+        """
+        import numpy as np
+        if len(self) == 0:
+            return self
+        scores = self.columns[score_column]
+        order = np.lexsort((-scores if descending else scores, self.columns[group_column]))
+        groups = self.columns[group_column][order]
+        group_starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+        rank = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+        return self.take(order[rank < n])
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Concatenates tables with the same columns into one table"""
+        import numpy as np
+        tables = [table for table in tables if table.columns]
+        if not tables:
+            return cls({})
+        columns = {}
+        dictionaries = {}
+        for name in tables[0].column_names:
+            if name in tables[0].dictionaries:
+                # Merge the dictionaries, then map each table's codes into the merged one
+                dictionary = np.unique(np.concatenate([table.dictionaries[name] for table in tables]))
+                dictionaries[name] = dictionary
+                columns[name] = np.concatenate([
+                    np.searchsorted(dictionary, table.dictionaries[name]).astype(np.int32)[table.columns[name]]
+                    for table in tables])
+            else:
+                columns[name] = np.concatenate([table.columns[name] for table in tables])
+        return cls(columns, dictionaries)
+
+    def to_records(self):
+        """Converts to a NumPy record array"""
+        import numpy as np
+        return np.rec.fromarrays([self[name] for name in self.column_names], names = self.column_names)
+
+    def to_pandas(self):
+        """Converts to a pandas DataFrame, with dictionary-encoded columns as categoricals. Requires pandas"""
+        import pandas
+        return pandas.DataFrame({name: pandas.Categorical.from_codes(column, self.dictionaries[name])
+                                 if name in self.dictionaries else column for name, column in self.columns.items()})
+
+    def to_arrow(self):
+        """Converts to a pyarrow Table, with dictionary-encoded columns as dictionary arrays. Requires pyarrow"""
+        import pyarrow
+        arrays = {}
+        for name, column in self.columns.items():
+            if name in self.dictionaries:
+                arrays[name] = pyarrow.DictionaryArray.from_arrays(column, self.dictionaries[name].tolist())
+            else:
+                arrays[name] = column.tolist() if column.dtype == object else column
+        return pyarrow.table(arrays)
+
+
+def split_whitespace_fields(lines, num_fields, comment_prefix = None):
+    """Finds the fields of whitespace-separated lines with NumPy, without splitting each line in Python
+
+    The last field runs to the end of the line, as str.split(None, num_fields - 1) would give.
+    Lines with fewer than num_fields - 1 fields are skipped, and ones without the last field get
+    an empty one.
+
+    Args:
+        lines (list): Lines as bytes, each ending in a newline except perhaps the last
+        num_fields (int): Number of fields per line
+        comment_prefix (bytes, optional): Skip lines starting with this. Defaults to None.
+
+    Returns:
+        tuple: (data, starts, ends) with data the kept lines joined into bytes, and starts and ends
+        (rows, num_fields) int64 arrays of the byte offsets of each field in data
+    """
+    import numpy as np
+    lines = [line for line in lines if line.strip() and not (comment_prefix is not None and line.startswith(comment_prefix))]
+    data = b''.join(lines)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    buf = np.frombuffer(data, dtype = np.uint8)
+    line_ends = np.flatnonzero(buf == 10)
+    space = (buf == 32) | (buf == 9) | (buf == 10) | (buf == 13)
+    token_starts = np.flatnonzero(~space & np.concatenate([[True], space[:-1]]))
+    token_ends = np.flatnonzero(~space & np.concatenate([space[1:], [True]])) + 1
+    token_lines = np.searchsorted(line_ends, token_starts)
+    first_tokens = np.searchsorted(token_lines, np.arange(len(line_ends)))
+    token_fields = np.arange(len(token_starts)) - first_tokens[token_lines]
+    tokens_per_line = np.bincount(token_lines, minlength = len(line_ends))
+    kept = tokens_per_line >= num_fields - 1
+    starts = np.empty((int(kept.sum()), num_fields), dtype = np.int64)
+    ends = np.empty_like(starts)
+    fixed = (token_fields < num_fields - 1) & kept[token_lines]
+    starts[:, :-1] = token_starts[fixed].reshape(-1, num_fields - 1)
+    ends[:, :-1] = token_ends[fixed].reshape(-1, num_fields - 1)
+    # The last field starts at the next token, if there is one, and runs to the end of the line
+    kept_ends = line_ends[kept]
+    ends[:, -1] = kept_ends - (buf[np.maximum(kept_ends - 1, 0)] == 13)
+    starts[:, -1] = ends[:, -1]
+    has_last = tokens_per_line[kept] >= num_fields
+    starts[has_last, -1] = token_starts[token_fields == num_fields - 1]
+    return data, starts, ends
+
+
+def _gather_fields(data, starts, ends):
+    """Copies fields into a fixed-width bytes array, one row per field"""
+    import numpy as np
+    buf = np.frombuffer(data, dtype = np.uint8)
+    widths = ends - starts
+    width = max(int(widths.max()) if len(widths) else 0, 1)
+    offsets = np.arange(width)
+    chars = buf[np.minimum(starts[:, None] + offsets, max(len(buf) - 1, 0))]
+    chars[offsets >= widths[:, None]] = 0
+    return np.ascontiguousarray(chars).view('S' + str(width)).ravel()
+
+
+def parse_numeric_fields(data, starts, ends, dtype):
+    """Converts fields found by split_whitespace_fields to a numeric column in one NumPy call"""
+    return _gather_fields(data, starts, ends).astype(dtype)
+
+
+def encode_string_fields(data, starts, ends):
+    """Dictionary-encodes fields found by split_whitespace_fields
+
+    Returns:
+        tuple: (int32 codes, object array of the sorted unique strings they index)
+    """
+    import numpy as np
+    widths = ends - starts
+    if len(widths) and int(widths.max()) > MAX_GATHER_WIDTH:
+        # Long free-text fields would make the fixed-width copy large, so slice them one by one
+        values = np.empty(len(starts), dtype = object)
+        values[:] = [data[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+    else:
+        values = _gather_fields(data, starts, ends)
+    unique, codes = np.unique(values, return_inverse = True)
+    dictionary = np.empty(len(unique), dtype = object)
+    dictionary[:] = [value.decode() for value in unique]
+    return codes.astype(np.int32).ravel(), dictionary
+
+
+def split_delimited_fields(lines, field_indices, delimiter = b'\t', comment_prefix = None):
+    """Finds the given fields of delimited lines with NumPy, without splitting each line in Python
+
+    Fields past the end of a line are empty, with equal start and end offsets. Blank lines are
+    skipped.
+
+    Args:
+        lines (list): Lines as bytes, each ending in a newline except perhaps the last
+        field_indices (list): Positions of the fields to find
+        delimiter (bytes, optional): Single-byte field delimiter. Defaults to tab.
+        comment_prefix (bytes, optional): Skip lines starting with this. Defaults to None.
+
+    Returns:
+        tuple: (data, starts, ends, num_fields) with data the kept lines joined into bytes, starts
+        and ends (rows, len(field_indices)) int64 arrays of the byte offsets of each field in data,
+        and num_fields the largest number of fields on any line
+    """
+    import numpy as np
+    lines = [line for line in lines if line.strip() and not (comment_prefix is not None and line.startswith(comment_prefix))]
+    data = b''.join(lines)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    buf = np.frombuffer(data, dtype = np.uint8)
+    line_ends = np.flatnonzero(buf == 10)
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1]).astype(np.int64)
+    content_ends = line_ends - (buf[np.maximum(line_ends - 1, 0)] == 13)
+    delims = np.flatnonzero(buf == ord(delimiter))
+    delim_lines = np.searchsorted(line_ends, delims)
+    first_delims = np.searchsorted(delim_lines, np.arange(len(line_ends)))
+    delims_per_line = np.bincount(delim_lines, minlength = len(line_ends))
+    # Padded so lookups past the last delimiter stay in bounds; those rows are masked out anyway
+    padded = np.append(delims, len(buf))
+    starts = np.empty((len(line_ends), len(field_indices)), dtype = np.int64)
+    ends = np.empty_like(starts)
+    for j, index in enumerate(field_indices):
+        if index == 0:
+            starts[:, j] = line_starts
+        else:
+            previous = padded[np.minimum(first_delims + index - 1, len(delims))] + 1
+            starts[:, j] = np.where(delims_per_line >= index, previous, content_ends)
+        following = padded[np.minimum(first_delims + index, len(delims))]
+        ends[:, j] = np.where(delims_per_line > index, following, content_ends)
+    num_fields = int(delims_per_line.max()) + 1 if len(line_ends) else 0
+    return data, starts, ends, num_fields
+
+
+def _numeric_with_missing(data, starts, ends, dtype):
+    """Converts fields to a numeric column, float64 with NaN for empty fields if there are any"""
+    import numpy as np
+    missing = starts == ends
+    if not missing.any():
+        return parse_numeric_fields(data, starts, ends, dtype)
+    column = np.full(len(starts), np.nan)
+    column[~missing] = parse_numeric_fields(data, starts[~missing], ends[~missing], dtype)
+    return column
+
+
+def iter_delimited_chunks(input_file, columns, chunk_size = 100000, usecols = None, delimiter = '\t',
+                          header_prefix = None, table_type = ColumnarTable):
+    """Reads a delimited text table in chunks, yielding a typed ColumnarTable per chunk
+
+    Fields are located with split_delimited_fields and each column of a chunk is converted with a
+    single NumPy call, so only the requested columns are read at all. String columns are
+    dictionary-encoded. Columns beyond the end of every row of a chunk are left out (e.g.
+    CheckM's 14-column default table read with its 26-column extended spec). Other missing or
+    empty fields are read as empty strings in string columns and NaN in numeric columns, which
+    makes integer columns with missing values float64.
+
+    Args:
+        input_file (str): Path to table
+        columns (list): (name, dtype) for every column in file order, with object for strings
+        chunk_size (int, optional): Lines per chunk. Defaults to 100000.
+        usecols (list, optional): Names of columns to keep. Defaults to None, all columns.
+        delimiter (str, optional): Single-character field delimiter. Defaults to tab.
+        header_prefix (str, optional): Skip lines starting with this, e.g. a header row. Defaults to None.
+        table_type (type, optional): ColumnarTable subclass to build. Defaults to ColumnarTable.
+
+    Yields:
+        ColumnarTable: One table per chunk of lines
+    """
+    wanted = [(i, name, dtype) for i, (name, dtype) in enumerate(columns) if usecols is None or name in usecols]
+    header_prefix = header_prefix.encode() if header_prefix is not None else None
+    with open(input_file, 'rb') as inf:
+        while True:
+            lines = list(itertools.islice(inf, chunk_size))
+            if not lines:
+                break
+            data, starts, ends, num_fields = split_delimited_fields(lines, [i for i, name, dtype in wanted],
+                                                                    delimiter.encode(), header_prefix)
+            if not len(starts):
+                continue
+            table_columns = {}
+            dictionaries = {}
+            for j, (i, name, dtype) in enumerate(wanted):
+                if i >= num_fields:
+                    continue
+                if dtype is object:
+                    table_columns[name], dictionaries[name] = encode_string_fields(data, starts[:, j], ends[:, j])
+                else:
+                    table_columns[name] = _numeric_with_missing(data, starts[:, j], ends[:, j], dtype)
+            yield table_type(table_columns, dictionaries)
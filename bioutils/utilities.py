@@ -1,5 +1,6 @@
-import os, subprocess, gzip, shutil
+import os, subprocess, gzip, shutil, tarfile, io
 from pathlib import Path
+from bioutils import bgzf
 
 def create_directory(directory):
     if not os.path.exists(directory):
@@ -17,6 +18,9 @@ def retrieve_basename(filepath):
     bname = Path(filepath).stem
     return bname
 
+# Name MMseqs outputs are built with, the same as retrieve_basename
+remove_extension = retrieve_basename
+
 def retrieve_extension(filepath):
     """Gets file extension without basename
     
@@ -62,3 +66,90 @@ def unpack_file(filepath):
                     shutil.copyfileobj(inf, outf)
         except:
             pass
+
+class _TarMembersReader(io.RawIOBase):
+    """Binary stream over the concatenated regular-file members of a tar archive"""
+    def __init__(self, filepath):
+        super().__init__()
+        self.archive = tarfile.open(filepath, 'r|*')
+        self.members = iter(self.archive)
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self.current is None:
+                member = next(self.members, None)
+                if member is None:
+                    return 0
+                if not member.isfile():
+                    continue
+                self.current = self.archive.extractfile(member)
+            n = self.current.readinto(b)
+            if n:
+                return n
+            self.current = None
+
+    def close(self):
+        if not self.closed:
+            self.archive.close()
+        super().close()
+
+
+def open_compressed(filepath, threads = 1):
+    """Opens a plain, gzip, BGZF or tar.gz file for binary streaming without writing temp files
+
+    BGZF files are detected from their header regardless of extension and decompressed in
+    parallel. Plain gzip uses python-isal's threaded reader when installed. Every regular file
+    in a .tar.gz/.tgz archive is streamed back to back.
+
+    Args:
+        filepath (str): Path to input file
+        threads (int, optional): Number of decompression threads. Defaults to 1.
+
+    Returns:
+        file: Readable binary file object
+    """
+    if filepath.endswith(('.tar.gz', '.tgz', '.tar')):
+        return io.BufferedReader(_TarMembersReader(filepath), buffer_size = 1024 * 1024)
+    if filepath.endswith(('.gz', '.bgz')):
+        if bgzf.is_bgzf(filepath):
+            return io.BufferedReader(bgzf.BgzfReader(filepath, threads), buffer_size = 1024 * 1024)
+        if threads > 1:
+            try:
+                from isal import igzip_threaded
+                return igzip_threaded.open(filepath, 'rb', threads = threads)
+            except ImportError:
+                pass
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb', buffering = 1024 * 1024)
+
+
+def open_compressed_writer(filepath, compression = 'bgzf', threads = 1, level = 6):
+    """Opens a file for binary writing, compressed as BGZF, gzip or not at all
+
+    Args:
+        filepath (str): Path to output file
+        compression (str, optional): 'bgzf', 'gzip' or None. Defaults to 'bgzf'.
+        threads (int, optional): Number of compression threads. Used for BGZF, and for gzip when
+            python-isal is installed. Defaults to 1.
+        level (int, optional): Compression level. Defaults to 6.
+
+    Returns:
+        file: Writable binary file object
+    """
+    if compression == 'bgzf':
+        return io.BufferedWriter(bgzf.BgzfWriter(filepath, threads, level), buffer_size = 1024 * 1024)
+    if compression == 'gzip':
+        if threads > 1:
+            try:
+                from isal import igzip_threaded
+                return igzip_threaded.open(filepath, 'wb', threads = threads)
+            except ImportError:
+                pass
+        return gzip.open(filepath, 'wb', compresslevel = level)
+    if compression is None:
+        return open(filepath, 'wb', buffering = 1024 * 1024)
+    raise ValueError('Unknown compression ' + repr(compression) + ", expected 'bgzf', 'gzip' or None")